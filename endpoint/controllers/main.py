@@ -3,37 +3,158 @@
 # License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
 
 
+import hashlib
+import hmac
 import json
+import logging
+import tempfile
+import threading
+import time
 
-from werkzeug.exceptions import NotFound
+import psycopg2
+from werkzeug.exceptions import (
+    BadRequest,
+    Forbidden,
+    HTTPException,
+    NotFound,
+    Unauthorized,
+)
+from werkzeug.wsgi import wrap_file
 
 from odoo import http
 from odoo.http import Response, request
+from odoo.tools import config
+
+from .. import utils
+from ..metrics import EndpointMetrics
+
+_logger = logging.getLogger(__name__)
+
+# Cached responses by key (see `endpoint.mixin._response_cache_key`)
+_RESPONSE_CACHE = None
+_RESPONSE_CACHE_LOCK = threading.Lock()
+# Default size of the response cache (in MB) of each worker
+RESPONSE_CACHE_SIZE = 64
+# Streamed bodies bigger than this are written to disk
+STREAM_SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+
+def _get_response_cache():
+    """Return the response cache of the current process.
+
+    Its size (bodies and their compressed variants) is bounded
+    by the `endpoint_response_cache_size` server option (in MB).
+    """
+    global _RESPONSE_CACHE
+    with _RESPONSE_CACHE_LOCK:
+        if _RESPONSE_CACHE is None:
+            size = int(
+                config.get("endpoint_response_cache_size") or RESPONSE_CACHE_SIZE
+            )
+            _RESPONSE_CACHE = utils.SizedLRU(size * 1024 * 1024)
+    return _RESPONSE_CACHE
 
 
 class EndpointControllerMixin:
+
+    # Max number of sub-requests of a batch
+    _batch_max_requests = 50
+
     def _handle_endpoint(self, env, endpoint_route, **params):
-        endpoint = self._find_endpoint(env, endpoint_route)
+        return self._handle_endpoint_request(request, env, endpoint_route, **params)
+
+    def _handle_endpoint_request(self, req, env, endpoint_route, **params):
+        """Handle given request w/ the endpoint matching given route.
+
+        :param req: current request or a sub-request (see `EndpointRequest`)
+        """
+        tracker = EndpointMetrics.metrics_for(env.cr.dbname).track(
+            endpoint_route, req.httprequest.method
+        )
+        try:
+            response = self._handle_endpoint_tracked(
+                tracker, req, env, endpoint_route, **params
+            )
+        except HTTPException as err:
+            tracker.done(err.code)
+            raise
+        except Exception:
+            tracker.done(500)
+            raise
+        tracker.done(response.status_code, response.content_length)
+        return response
+
+    def _handle_endpoint_tracked(self, tracker, req, env, endpoint_route, **params):
+        endpoint, route_params = self._match_endpoint(env, endpoint_route, params)
+        tracker.lap("lookup")
         if not endpoint:
             raise NotFound()
-        endpoint._validate_request(request)
-        result = endpoint._handle_request(request)
-        return self._handle_result(result)
+        # Paths (eg: `/order/1` in batches) would make labels grow w/o bounds
+        tracker.route = endpoint.route
+        if route_params:
+            endpoint = endpoint.with_context(endpoint_route_params=route_params)
+        endpoint._validate_request(req)
+        cache_key = endpoint._response_cache_key(req)
+        tracker.lap("validate")
+        if cache_key:
+            cached = _get_response_cache().get(cache_key)
+            if cached and cached["expires_at"] > time.time():
+                response = self._make_cached_response(cached, req=req)
+                tracker.lap("serialize")
+                return response
+        if endpoint.read_only:
+            # Serialize the result before the cursor is closed
+            # as it might be lazy (eg: records, generators).
+            with endpoint._endpoint_read_only_env() as read_only_env:
+                return self._handle_endpoint_call(
+                    tracker, req, endpoint.with_env(read_only_env), cache_key
+                )
+        return self._handle_endpoint_call(tracker, req, endpoint, cache_key)
+
+    def _handle_endpoint_call(self, tracker, req, endpoint, cache_key):
+        result = endpoint._handle_request(req)
+        tracker.lap("handle")
+        response = self._handle_result(
+            result, endpoint=endpoint, cache_key=cache_key, req=req
+        )
+        tracker.lap("serialize")
+        return response
 
-    def _handle_result(self, result):
+    def _handle_result(self, result, endpoint=None, cache_key=None, req=None):
+        response = self._make_result_response(result)
+        if cache_key and self._is_response_cacheable(response):
+            cached = self._cache_response(cache_key, endpoint, response)
+            # Reply w/ the same headers a cache hit would get
+            return self._make_cached_response(cached, req=req)
+        if endpoint and endpoint.compress_min_size:
+            response = self._compress_response(
+                response, endpoint.compress_min_size, req=req
+            )
+        return response
+
+    def _make_result_response(self, result):
         response = result.get("response")
         if isinstance(response, Response):
             # Full response already provided
+            if response.is_streamed and not response.direct_passthrough:
+                return self._spool_response(response)
             return response
-        payload = result.get("payload", "")
         status = result.get("status_code", 200)
         headers = result.get("headers", {})
+        if result.get("payload_iter") is not None:
+            return self._make_json_stream_response(
+                result["payload_iter"],
+                payload_format=result.get("payload_format", "json"),
+                headers=headers,
+                status=status,
+            )
+        payload = result.get("payload", "")
         return self._make_json_response(payload, headers=headers, status=status)
 
     # TODO: probably not needed anymore as controllers are automatically registered
     def _make_json_response(self, payload, headers=None, status=200, **kw):
         # TODO: guess out type?
-        data = json.dumps(payload)
+        data = self._json_dumps(payload)
         if headers is None:
             headers = {}
         headers["Content-Type"] = "application/json"
@@ -41,9 +162,381 @@ class EndpointControllerMixin:
         resp.status = str(status)
         return resp
 
+    def _json_dumps(self, payload):
+        """Serialize payload to JSON bytes.
+
+        Override this to use a different encoder.
+        """
+        return utils.json_dumps(payload)
+
+    # Streaming
+    #
+    # The body of a response is consumed by the WSGI server
+    # once the request is over, hence once its cursor is closed.
+    # To let snippets stream their data w/ the ORM, the body is generated
+    # while the request is still open and written chunk by chunk
+    # into a temporary file which is then streamed to the client:
+    # the whole payload is never held in memory.
+
+    def _make_json_stream_response(
+        self, items, payload_format="json", headers=None, status=200
+    ):
+        """Stream items as a JSON array or as NDJSON.
+
+        :param items: an iterable of JSON serializable values
+        :param payload_format: `json` or `ndjson`
+        """
+        if payload_format == "ndjson":
+            chunks = self._iter_ndjson_chunks(items)
+            content_type = "application/x-ndjson"
+        else:
+            chunks = self._iter_json_array_chunks(items)
+            content_type = "application/json"
+        headers = dict(headers or {})
+        headers["Content-Type"] = content_type
+        return self._make_spooled_response(chunks, headers=headers, status=status)
+
+    def _iter_json_array_chunks(self, items):
+        yield b"["
+        for i, item in enumerate(items):
+            if i:
+                yield b","
+            yield self._json_dumps(item)
+        yield b"]"
+
+    def _iter_ndjson_chunks(self, items):
+        for item in items:
+            yield self._json_dumps(item) + b"\n"
+
+    def _spool_response(self, response):
+        """Replace the body of a streamed response w/ a spooled one."""
+        body, size = self._spool_chunks(response.iter_encoded())
+        response.response = wrap_file(request.httprequest.environ, body)
+        response.direct_passthrough = True
+        response.content_length = size
+        return response
+
+    def _make_spooled_response(self, chunks, headers=None, status=200):
+        body, size = self._spool_chunks(chunks)
+        response = Response(
+            wrap_file(request.httprequest.environ, body),
+            headers=headers,
+            status=status,
+            direct_passthrough=True,
+        )
+        response.content_length = size
+        return response
+
+    def _spool_chunks(self, chunks):
+        body = tempfile.SpooledTemporaryFile(max_size=STREAM_SPOOL_MAX_SIZE)
+        size = 0
+        for chunk in chunks:
+            body.write(chunk)
+            size += len(chunk)
+        body.seek(0)
+        return body, size
+
+    def _is_response_cacheable(self, response):
+        return (
+            isinstance(response, Response)
+            and response.status_code == 200
+            and not response.is_streamed
+        )
+
+    @classmethod
+    def _response_cache_drop(cls, rec_keys):
+        """Drop the cached responses of given endpoints.
+
+        :param rec_keys: set of `(dbname, model, id)` tuples
+        """
+        cache = _get_response_cache()
+        for cache_key in cache.keys():
+            if cache_key[:3] in rec_keys:
+                cache.pop(cache_key)
+
+    def _cache_response(self, cache_key, endpoint, response):
+        body = response.get_data()
+        response.set_etag(hashlib.sha1(body).hexdigest())
+        if endpoint.cache_scope == "public":
+            response.cache_control.public = True
+        else:
+            response.cache_control.private = True
+        response.cache_control.max_age = endpoint.cache_ttl
+        cached = {
+            "expires_at": time.time() + endpoint.cache_ttl,
+            "status": response.status,
+            "headers": [
+                (k, v) for k, v in response.headers.items() if k.lower() != "set-cookie"
+            ],
+            "body": body,
+            "compress_min_size": endpoint.compress_min_size,
+            # Compressed bodies by encoding
+            "encoded": {},
+            "key": cache_key,
+        }
+        _get_response_cache().set(cache_key, cached, len(body))
+        return cached
+
+    def _make_cached_response(self, cached, req=None):
+        req = req or request
+        body = cached["body"]
+        encoding = None
+        if cached["compress_min_size"]:
+            encoding = self._get_response_encoding(
+                req, len(body), cached["compress_min_size"]
+            )
+        if encoding:
+            encoded = cached["encoded"]
+            if encoding not in encoded:
+                # Compress once per cached response
+                encoded[encoding] = utils.compress(body, encoding)
+                _get_response_cache().grow(cached["key"], len(encoded[encoding]))
+            body = encoded[encoding]
+        response = Response(body, status=cached["status"], headers=cached["headers"])
+        if cached["compress_min_size"]:
+            response.vary.add("Accept-Encoding")
+        if encoding:
+            self._set_response_encoding(response, encoding)
+        # Reply `304 Not Modified` when `If-None-Match` matches the ETag
+        return response.make_conditional(req.httprequest)
+
+    # Compression
+
+    def _get_response_encoding(self, req, size, min_size):
+        """Return the encoding to compress the response w/, if any.
+
+        :param size: size of the uncompressed body
+        :param min_size: smaller bodies are not compressed
+        """
+        if size is None or size < min_size:
+            return None
+        return utils.select_encoding(req.httprequest.accept_encodings)
+
+    def _compress_response(self, response, min_size, req=None):
+        """Compress the body according to the `Accept-Encoding` of the request."""
+        req = req or request
+        if (
+            not isinstance(response, Response)
+            or response.status_code in (204, 304)
+            or "Content-Encoding" in response.headers
+        ):
+            return response
+        response.vary.add("Accept-Encoding")
+        if response.direct_passthrough:
+            # Spooled body (see `_spool_chunks`)
+            encoding = self._get_response_encoding(
+                req, response.content_length, min_size
+            )
+            if encoding:
+                file_wrapper = response.response
+                try:
+                    body, size = self._spool_chunks(
+                        utils.iter_compressed(file_wrapper, encoding)
+                    )
+                finally:
+                    file_wrapper.close()
+                response.response = wrap_file(req.httprequest.environ, body)
+                response.content_length = size
+        else:
+            data = response.get_data()
+            encoding = self._get_response_encoding(req, len(data), min_size)
+            if encoding:
+                response.set_data(utils.compress(data, encoding))
+        if encoding:
+            self._set_response_encoding(response, encoding)
+        return response
+
+    def _set_response_encoding(self, response, encoding):
+        response.headers["Content-Encoding"] = encoding
+        etag, weak = response.get_etag()
+        if etag:
+            # Each variant of the response has its own ETag
+            response.set_etag("{}-{}".format(etag, encoding), weak=weak)
+
     def _find_endpoint(self, env, endpoint_route):
         return env["endpoint.endpoint"]._find_endpoint(endpoint_route)
 
+    def _match_endpoint(self, env, endpoint_route, params):
+        """Find the endpoint and the route params of current request.
+
+        :param params: arguments of the request,
+            including values of the converters of the route
+        :return: tuple `(endpoint, route params)`
+        """
+        endpoint, route_params = env["endpoint.endpoint"]._match_endpoint(
+            endpoint_route
+        )
+        if endpoint and not route_params:
+            route_params = {
+                name: params[name]
+                for name in endpoint._get_route_param_names()
+                if name in params
+            }
+        return endpoint, route_params
+
+    # Batch
+    #
+    # Several endpoint calls can be done in one request.
+    # Each call is handled as a sub-request (see `EndpointRequest`).
+
+    def _handle_batch(self, env, sub_requests, mode="independent"):
+        """Handle given sub-requests and return their responses in the same order.
+
+        :param sub_requests: list of dict w/ `route`, `method`, `params`,
+            `headers` and `body` keys
+        :param mode: `independent` to handle each sub-request in its own savepoint,
+            `transaction` to roll back all of them as soon as one fails
+        :return: list of dict w/ `status`, `headers` and `body` keys
+        """
+        if mode != "transaction":
+            return [self._batch_handle_sub_request(env, x) for x in sub_requests]
+        results = []
+        try:
+            with env.cr.savepoint():
+                for sub_request in sub_requests:
+                    result = self._batch_handle_sub_request(env, sub_request)
+                    results.append(result)
+                    if result["status"] >= 400:
+                        raise _BatchAborted()
+        except _BatchAborted:
+            failed = results[-1]
+            results = [
+                failed if i == len(results) - 1 else self._batch_failed_dependency()
+                for i in range(len(sub_requests))
+            ]
+        return results
+
+    def _batch_failed_dependency(self):
+        return {"status": 424, "headers": {}, "body": "Failed Dependency"}
+
+    def _batch_parse(self, req):
+        """Return sub-requests and mode from the body of the batch request."""
+        try:
+            data = json.loads(req.httprequest.get_data() or b"null")
+        except ValueError as err:
+            raise BadRequest("Invalid JSON body") from err
+        if not isinstance(data, dict) or not isinstance(data.get("requests"), list):
+            raise BadRequest("`requests` must be a list")
+        sub_requests = data["requests"]
+        if len(sub_requests) > self._batch_max_requests:
+            raise BadRequest(
+                "Too many requests (max {})".format(self._batch_max_requests)
+            )
+        for sub_request in sub_requests:
+            if not isinstance(sub_request, dict) or not str(
+                sub_request.get("route") or ""
+            ).startswith("/"):
+                raise BadRequest("Each request must provide a `route`")
+        mode = data.get("mode") or "independent"
+        if mode not in ("independent", "transaction"):
+            raise BadRequest("Invalid mode `{}`".format(mode))
+        return sub_requests, mode
+
+    def _batch_make_sub_request(self, env, sub_request):
+        # Bodies of sub-requests are sent as part of the batch response:
+        # they must not be compressed.
+        headers = {
+            k: v
+            for k, v in (sub_request.get("headers") or {}).items()
+            if k.lower() != "accept-encoding"
+        }
+        body = sub_request.get("body")
+        if body is not None and not isinstance(body, str):
+            body = json.dumps(body)
+            headers.setdefault("Content-Type", "application/json")
+        return utils.EndpointRequest.build(
+            env,
+            sub_request["route"],
+            method=(sub_request.get("method") or "GET").upper(),
+            query_string=sub_request.get("params") or None,
+            headers=headers,
+            data=body,
+        )
+
+    def _batch_handle_sub_request(self, env, sub_request):
+        route = sub_request["route"]
+        try:
+            sub_req = self._batch_make_sub_request(env, sub_request)
+            with env.cr.savepoint():
+                endpoint = self._match_endpoint(env, route, sub_req.params)[0]
+                if not endpoint:
+                    raise NotFound()
+                self._batch_check_access(sub_req, endpoint)
+                response = self._handle_endpoint_request(
+                    sub_req, sub_req.env, route, **sub_req.params
+                )
+                return self._batch_response_values(response)
+        except HTTPException as err:
+            return {"status": err.code, "headers": {}, "body": err.description}
+        except psycopg2.OperationalError:
+            # Eg: serialization failures, let Odoo retry the whole batch
+            raise
+        except Exception:
+            _logger.exception("Batch request to %s failed", route)
+            return {"status": 500, "headers": {}, "body": "Internal Server Error"}
+
+    def _batch_check_csrf(self, req):
+        """Protect batches authenticated by the session against CSRF.
+
+        Browsers send the session cookie w/ cross-site requests:
+        a valid token is then required as `X-CSRF-Token` header
+        or `csrf_token` parameter.
+        Batches sent w/ an API key header are not concerned.
+        """
+        if not req.session.uid:
+            return
+        if req.env["ir.http"]._endpoint_get_api_key(req.httprequest):
+            return
+        token = req.httprequest.headers.get("X-CSRF-Token") or req.params.get(
+            "csrf_token"
+        )
+        if not req.validate_csrf(token):
+            raise BadRequest("Session expired (invalid CSRF token)")
+
+    def _batch_check_access(self, req, endpoint):
+        """Check what the routing does for standalone calls.
+
+        Sub-requests to endpoints using API keys are handled
+        as the owner of the key sent w/ the sub-request or w/ the batch.
+        """
+        if endpoint.auth_type == "api_key":
+            uid = self._batch_api_key_uid(req)
+            if not uid:
+                raise Unauthorized()
+            req.env = req.env(user=uid)
+        elif endpoint.auth_type != "public" and req.env.user._is_public():
+            raise Unauthorized()
+        if endpoint.csrf and req.httprequest.method not in (
+            "GET",
+            "HEAD",
+            "OPTIONS",
+            "TRACE",
+        ):
+            if not request.validate_csrf(req.params.pop("csrf_token", None)):
+                raise BadRequest("Session expired (invalid CSRF token)")
+
+    def _batch_api_key_uid(self, req):
+        get_api_key = req.env["ir.http"]._endpoint_get_api_key
+        key = get_api_key(req.httprequest) or get_api_key(request.httprequest)
+        if not key:
+            return None
+        apikeys = req.env["res.users.apikeys"].sudo()
+        return apikeys._endpoint_check_credentials(key)
+
+    def _batch_response_values(self, response):
+        try:
+            body = b"".join(response.iter_encoded())
+        finally:
+            response.close()
+        if response.mimetype == "application/json" and body:
+            body = json.loads(body)
+        else:
+            body = body.decode(response.charset or "utf-8", "replace")
+        headers = {
+            k: v for k, v in response.headers.items() if k.lower() != "set-cookie"
+        }
+        return {"status": response.status_code, "headers": headers, "body": body}
+
     def auto_endpoint(self, endpoint_route, **params):
         """Default method to handle auto-generated endpoints"""
         env = request.env
@@ -51,4 +544,80 @@ class EndpointControllerMixin:
 
 
 class EndpointController(http.Controller, EndpointControllerMixin):
-    pass
+    @http.route("/endpoint/metrics", type="http", auth="public", methods=["GET"])
+    def metrics(self):
+        """Expose endpoint metrics in Prometheus text format.
+
+        Access is granted to admins or to clients providing
+        the token set in `endpoint.metrics_token` system parameter
+        as `Authorization: Bearer <token>` header.
+        """
+        if not self._metrics_access_allowed():
+            raise Forbidden()
+        metrics = EndpointMetrics.metrics_for(request.env.cr.dbname)
+        return Response(
+            metrics.export(), content_type="text/plain; version=0.0.4; charset=utf-8"
+        )
+
+    @http.route(
+        "/endpoint/job/<string:token>", type="http", auth="public", methods=["GET"]
+    )
+    def job_status(self, token):
+        """Reply w/ the status of a job or w/ its result when done.
+
+        The token is the secret given when the job was created.
+        """
+        job = request.env["endpoint.job"]._find_by_token(token)
+        if not job:
+            raise NotFound()
+        # Do not let clients poll lost jobs until the next autovacuum
+        job.filtered_domain(job._get_stale_domain())._fail_stale()
+        if job.state == "done":
+            return Response(
+                job._get_result_body(),
+                status=job.result_status,
+                content_type=job.result_content_type,
+            )
+        status = 202 if job.state in ("pending", "running") else job.result_status
+        return self._make_json_response(job._get_status_payload(), status=status)
+
+    @http.route(
+        "/endpoint/batch", type="http", auth="public", methods=["POST"], csrf=False
+    )
+    def batch(self):
+        """Handle several endpoint calls in one request.
+
+        Expect a JSON body like::
+
+            {
+                "mode": "independent",
+                "requests": [
+                    {"route": "/my/endpoint", "method": "GET", "params": {"a": 1}},
+                    {"route": "/my/other", "method": "POST", "body": {"b": 2}}
+                ]
+            }
+
+        and reply w/ the list of responses in the same order.
+
+        When authenticated by the session, a CSRF token is required
+        (see `_batch_check_csrf`).
+        """
+        self._batch_check_csrf(request)
+        sub_requests, mode = self._batch_parse(request)
+        results = self._handle_batch(request.env, sub_requests, mode=mode)
+        return self._make_json_response(results)
+
+    def _metrics_access_allowed(self):
+        token = (
+            request.env["ir.config_parameter"]
+            .sudo()
+            .get_param("endpoint.metrics_token")
+        )
+        auth = request.httprequest.headers.get("Authorization", "")
+        if token and auth.startswith("Bearer "):
+            return hmac.compare_digest(auth[len("Bearer ") :], token)
+        return request.env.user.has_group("base.group_system")
+
+
+class _BatchAborted(Exception):
+    """Roll back a batch handled in `transaction` mode."""
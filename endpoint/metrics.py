@@ -0,0 +1,264 @@
+# Copyright 2021 Camptocamp SA
+# @author: Simone Orsi <simone.orsi@camptocamp.com>
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
+
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from odoo.tools import config
+
+_logger = logging.getLogger(__name__)
+
+_METRICS_BY_DB = {}
+
+# Metric name: (type, help, histogram buckets)
+METRICS = {
+    "endpoint_requests_total": ("counter", "Requests handled by endpoints.", None),
+    "endpoint_timeouts_total": (
+        "counter",
+        "Requests exceeding the max SQL statement time or the max execution time.",
+        None,
+    ),
+    "endpoint_request_duration_seconds": (
+        "histogram",
+        "Time spent handling endpoint requests by phase.",
+        (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+    ),
+    "endpoint_response_size_bytes": (
+        "histogram",
+        "Size of endpoint responses.",
+        (100, 1000, 10000, 100000, 1000000, 10000000, 100000000),
+    ),
+}
+
+
+class EndpointMetrics:
+    """Collect metrics about endpoint traffic.
+
+    Metrics are collected in memory by each process
+    and periodically dumped to a file shared by all the workers
+    so that exported metrics cover all of them.
+    """
+
+    # Min seconds between 2 dumps of the metrics of the current process
+    flush_interval = 5
+    # Files of dead processes not updated since more than this are dropped
+    stale_after = 24 * 3600
+
+    __slots__ = ("dbname", "_lock", "_counters", "_histograms", "_last_flush")
+
+    def __init__(self, dbname):
+        self.dbname = dbname
+        self._lock = threading.Lock()
+        # {(name, labels): value}
+        self._counters = {}
+        # {(name, labels): [bucket counts..., +Inf count, sum, count]}
+        self._histograms = {}
+        self._last_flush = time.time()
+
+    @classmethod
+    def metrics_for(cls, dbname):
+        if dbname not in _METRICS_BY_DB:
+            _METRICS_BY_DB[dbname] = cls(dbname)
+        return _METRICS_BY_DB[dbname]
+
+    @classmethod
+    def wipe_metrics_for(cls, dbname):
+        if dbname in _METRICS_BY_DB:
+            del _METRICS_BY_DB[dbname]
+
+    def inc(self, name, labels, value=1):
+        """Increment a counter.
+
+        :param labels: tuple of `(label, value)` pairs
+        """
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        """Record a value into an histogram."""
+        buckets = METRICS[name][2]
+        key = (name, labels)
+        with self._lock:
+            values = self._histograms.get(key)
+            if values is None:
+                values = self._histograms[key] = [0] * (len(buckets) + 3)
+            # Buckets are made cumulative on export
+            values[bisect_left(buckets, value)] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    def track(self, route, method):
+        return RequestTracker(self, route, method)
+
+    # Storage shared by workers
+
+    def _get_storage_path(self):
+        return os.path.join(config["data_dir"], "endpoint_metrics", self.dbname)
+
+    def _get_process_filename(self):
+        return "{}.json".format(os.getpid())
+
+    def _snapshot(self):
+        with self._lock:
+            return {
+                "counters": [
+                    [name, labels, value]
+                    for (name, labels), value in self._counters.items()
+                ],
+                "histograms": [
+                    [name, labels, values]
+                    for (name, labels), values in self._histograms.items()
+                ],
+            }
+
+    def maybe_flush(self):
+        if time.time() - self._last_flush > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Dump metrics of current process to its own file."""
+        self._last_flush = time.time()
+        path = self._get_storage_path()
+        filepath = os.path.join(path, self._get_process_filename())
+        tmp_filepath = filepath + ".tmp"
+        try:
+            os.makedirs(path, exist_ok=True)
+            with open(tmp_filepath, "w") as fd:
+                json.dump(self._snapshot(), fd)
+            os.replace(tmp_filepath, filepath)
+        except OSError as err:
+            _logger.warning("Cannot write endpoint metrics: %s", err)
+
+    def _load_snapshots(self):
+        """Yield metrics of all processes, current one excluded."""
+        path = self._get_storage_path()
+        if not os.path.isdir(path):
+            return
+        own_filename = self._get_process_filename()
+        for filename in os.listdir(path):
+            if not filename.endswith(".json") or filename == own_filename:
+                continue
+            filepath = os.path.join(path, filename)
+            try:
+                if self._is_stale(filepath):
+                    os.unlink(filepath)
+                    continue
+                with open(filepath) as fd:
+                    yield json.load(fd)
+            except (OSError, ValueError) as err:
+                _logger.warning("Cannot read endpoint metrics %s: %s", filepath, err)
+
+    def _is_stale(self, filepath):
+        if time.time() - os.path.getmtime(filepath) < self.stale_after:
+            return False
+        pid = os.path.basename(filepath).split(".")[0]
+        try:
+            os.kill(int(pid), 0)
+        except (ValueError, OSError):
+            return True
+        return False
+
+    def collect(self):
+        """Merge metrics of all the processes."""
+        counters = {}
+        histograms = {}
+        for snapshot in [self._snapshot()] + list(self._load_snapshots()):
+            for name, labels, value in snapshot["counters"]:
+                key = (name, tuple(tuple(x) for x in labels))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, values in snapshot["histograms"]:
+                key = (name, tuple(tuple(x) for x in labels))
+                merged = histograms.get(key)
+                if merged is None:
+                    histograms[key] = list(values)
+                else:
+                    histograms[key] = [a + b for a, b in zip(merged, values)]
+        return counters, histograms
+
+    def export(self):
+        """Export metrics in Prometheus text format."""
+        counters, histograms = self.collect()
+        lines = []
+        for name, (metric_type, help_text, buckets) in METRICS.items():
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, metric_type))
+            if metric_type == "counter":
+                for (key_name, labels), value in sorted(counters.items()):
+                    if key_name == name:
+                        lines.append(_format_sample(name, labels, value))
+                continue
+            for (key_name, labels), values in sorted(histograms.items()):
+                if key_name != name:
+                    continue
+                cumulated = 0
+                for bound, count in zip(buckets + ("+Inf",), values):
+                    cumulated += count
+                    lines.append(
+                        _format_sample(
+                            name + "_bucket", labels + (("le", str(bound)),), cumulated
+                        )
+                    )
+                lines.append(_format_sample(name + "_sum", labels, values[-2]))
+                lines.append(_format_sample(name + "_count", labels, values[-1]))
+        return "\n".join(lines) + "\n"
+
+
+def _format_sample(name, labels, value):
+    labels_str = ",".join(
+        '{}="{}"'.format(
+            label,
+            str(label_value)
+            .replace("\\", "\\\\")
+            .replace('"', '\\"')
+            .replace("\n", "\\n"),
+        )
+        for label, label_value in labels
+    )
+    return "{}{{{}}} {}".format(name, labels_str, value)
+
+
+class RequestTracker:
+    """Track timings and outcome of a single request."""
+
+    __slots__ = ("metrics", "route", "method", "_start", "_last", "timings")
+
+    def __init__(self, metrics, route, method):
+        self.metrics = metrics
+        self.route = route
+        self.method = method
+        self._start = self._last = time.perf_counter()
+        self.timings = {}
+
+    def lap(self, phase):
+        """Record the time elapsed since previous lap for given phase."""
+        now = time.perf_counter()
+        self.timings[phase] = self.timings.get(phase, 0) + now - self._last
+        self._last = now
+
+    def done(self, status, size=None):
+        metrics = self.metrics
+        route_labels = (("route", self.route),)
+        metrics.inc(
+            "endpoint_requests_total",
+            route_labels + (("method", self.method), ("status", str(status))),
+        )
+        for phase, duration in self.timings.items():
+            metrics.observe(
+                "endpoint_request_duration_seconds",
+                route_labels + (("phase", phase),),
+                duration,
+            )
+        metrics.observe(
+            "endpoint_request_duration_seconds",
+            route_labels + (("phase", "total"),),
+            time.perf_counter() - self._start,
+        )
+        if size is not None:
+            metrics.observe("endpoint_response_size_bytes", route_labels, size)
+        metrics.maybe_flush()
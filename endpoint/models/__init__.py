@@ -1,2 +1,3 @@
 from . import endpoint_mixin
 from . import endpoint_endpoint
+from . import endpoint_job
@@ -0,0 +1,283 @@
+# Copyright 2021 Camptocamp SA
+# @author: Simone Orsi <simone.orsi@camptocamp.com>
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
+
+import base64
+import json
+import logging
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import werkzeug
+
+import odoo
+from odoo import SUPERUSER_ID, _, api, exceptions, fields, models
+from odoo.tools import config
+
+from ..utils import EndpointRequest, json_dumps
+
+_logger = logging.getLogger(__name__)
+
+_EXECUTOR = None
+_EXECUTOR_LOCK = threading.Lock()
+
+
+def _get_executor():
+    """Return the pool of threads running jobs of the current process.
+
+    Its size is controlled by the `endpoint_job_workers` server option.
+    """
+    global _EXECUTOR
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None:
+            _EXECUTOR = ThreadPoolExecutor(
+                max_workers=int(config.get("endpoint_job_workers") or 2),
+                thread_name_prefix="endpoint_job",
+            )
+    return _EXECUTOR
+
+
+def _run_job(dbname, job_id):
+    threading.current_thread().dbname = dbname
+    try:
+        with api.Environment.manage():
+            with odoo.registry(dbname).cursor() as cr:
+                env = api.Environment(cr, SUPERUSER_ID, {})
+                env["endpoint.job"].browse(job_id)._run()
+    except Exception:
+        _logger.exception("Endpoint job %s failed", job_id)
+
+
+class EndpointJob(models.Model):
+    """Request to an endpoint executed in background."""
+
+    _name = "endpoint.job"
+    _description = "Endpoint job"
+    _order = "id desc"
+
+    # Done and failed jobs are dropped after this delay
+    _gc_delay = timedelta(days=1)
+    # Jobs not done after this delay (in seconds) are considered as lost,
+    # eg: the worker was stopped. See `endpoint_job_timeout` server option.
+    _default_timeout = 3600
+    # Headers of the request kept to run the job, besides custom `X-*` headers.
+    # Credentials (eg: `Cookie`, `Authorization`, `API-KEY`) are never stored.
+    _request_headers_to_store = ("Content-Type", "Accept", "Accept-Language")
+    # Custom headers containing these words are considered as credentials
+    _request_headers_secret_words = (
+        "auth",
+        "cookie",
+        "csrf",
+        "key",
+        "password",
+        "secret",
+        "session",
+        "token",
+    )
+
+    token = fields.Char(required=True, index=True, readonly=True, copy=False)
+    res_model = fields.Char(string="Endpoint model", required=True, readonly=True)
+    res_id = fields.Integer(string="Endpoint ID", required=True, readonly=True)
+    route = fields.Char(readonly=True)
+    user_id = fields.Many2one(comodel_name="res.users", required=True, readonly=True)
+    state = fields.Selection(
+        selection=[
+            ("pending", "Pending"),
+            ("running", "Running"),
+            ("done", "Done"),
+            ("failed", "Failed"),
+        ],
+        default="pending",
+        required=True,
+        readonly=True,
+    )
+    date_started = fields.Datetime(readonly=True)
+    date_done = fields.Datetime(readonly=True)
+    # Request
+    request_method = fields.Char(readonly=True)
+    request_path = fields.Char(readonly=True)
+    request_query_string = fields.Char(readonly=True)
+    request_headers = fields.Text(readonly=True)
+    request_body = fields.Binary(attachment=False, readonly=True)
+    route_params = fields.Text(readonly=True)
+    # Result
+    result_status = fields.Integer(readonly=True)
+    result_content_type = fields.Char(readonly=True)
+    result_body = fields.Binary(attachment=False, readonly=True)
+    error = fields.Text(readonly=True)
+
+    @api.model
+    def _create_from_request(self, endpoint, request):
+        """Record given request to be executed by given endpoint."""
+        httprequest = request.httprequest
+        route_params = endpoint._get_route_params()
+        return self.sudo().create(
+            {
+                "token": secrets.token_urlsafe(32),
+                "res_model": endpoint._name,
+                "res_id": endpoint.id,
+                "route": endpoint.route,
+                "user_id": endpoint.env.uid,
+                "request_method": httprequest.method,
+                "request_path": httprequest.path,
+                "request_query_string": httprequest.query_string.decode(),
+                "request_headers": json.dumps(self._get_request_headers(httprequest)),
+                "request_body": base64.b64encode(httprequest.get_data()),
+                "route_params": json.dumps(route_params) if route_params else False,
+            }
+        )
+
+    @api.model
+    def _get_request_headers(self, httprequest):
+        """Return the headers of the request needed to run the job."""
+        to_store = {x.lower() for x in self._request_headers_to_store}
+        headers = []
+        for name, value in httprequest.headers.items():
+            lower_name = name.lower()
+            if lower_name in to_store or (
+                lower_name.startswith("x-")
+                and not any(x in lower_name for x in self._request_headers_secret_words)
+            ):
+                headers.append((name, value))
+        return headers
+
+    @api.model
+    def _find_by_token(self, token):
+        return self.sudo().search([("token", "=", token)], limit=1)
+
+    def _get_status_url(self):
+        return "/endpoint/job/{}".format(self.token)
+
+    def _schedule(self):
+        """Run jobs in background once the current transaction is committed."""
+        dbname = self.env.cr.dbname
+        for job_id in self.ids:
+            self.env.cr.postcommit.add(
+                lambda job_id=job_id: _get_executor().submit(_run_job, dbname, job_id)
+            )
+
+    def _make_request(self, env):
+        """Rebuild the recorded request."""
+        return EndpointRequest.build(
+            env,
+            self.request_path,
+            method=self.request_method,
+            query_string=self.request_query_string,
+            headers=json.loads(self.request_headers or "[]"),
+            data=base64.b64decode(self.request_body or b""),
+        )
+
+    def _get_endpoint(self):
+        endpoint = (
+            self.env[self.res_model]
+            .with_user(self.user_id)
+            .browse(self.res_id)
+            .with_context(endpoint_job_run=True)
+        )
+        if self.route_params:
+            endpoint = endpoint.with_context(
+                endpoint_route_params=json.loads(self.route_params)
+            )
+        return endpoint
+
+    def _run(self):
+        """Execute the request and store its result."""
+        self.ensure_one()
+        if self.state != "pending":
+            return
+        self.write({"state": "running", "date_started": fields.Datetime.now()})
+        # Let clients know the job is running
+        self.env.cr.commit()
+        values = {"date_done": fields.Datetime.now()}
+        try:
+            with self.env.cr.savepoint():
+                endpoint = self._get_endpoint()
+                result = endpoint._handle_request(self._make_request(endpoint.env))
+                values.update(self._get_result_values(result))
+                values["state"] = "done"
+        except werkzeug.exceptions.HTTPException as err:
+            values.update(state="failed", result_status=err.code, error=err.description)
+        except exceptions.UserError as err:
+            values.update(state="failed", result_status=400, error=err.args[0])
+        except Exception:
+            _logger.exception("Endpoint job %s failed", self.id)
+            values.update(
+                state="failed", result_status=500, error=_("Internal Server Error")
+            )
+        self.env.clear()
+        self.write(values)
+
+    def _get_result_values(self, result):
+        """Convert the result of the endpoint to values to store."""
+        response = result.get("response")
+        if response is not None:
+            return {
+                "result_status": response.status_code,
+                "result_content_type": response.headers.get("Content-Type"),
+                "result_body": base64.b64encode(response.get_data()),
+            }
+        if result.get("payload_iter") is not None:
+            payload = list(result["payload_iter"])
+        else:
+            payload = result.get("payload", "")
+        return {
+            "result_status": result.get("status_code", 200),
+            "result_content_type": "application/json",
+            "result_body": base64.b64encode(json_dumps(payload)),
+        }
+
+    def _get_result_body(self):
+        return base64.b64decode(self.result_body or b"")
+
+    def _get_status_payload(self):
+        payload = {"job": self.token, "status": self.state}
+        if self.state in ("pending", "running"):
+            payload["status_url"] = self._get_status_url()
+        if self.state == "failed":
+            payload["error"] = self.error
+        return payload
+
+    def _get_timeout(self):
+        return timedelta(
+            seconds=int(config.get("endpoint_job_timeout") or self._default_timeout)
+        )
+
+    def _get_stale_domain(self):
+        """Match pending or running jobs that did not complete in time."""
+        limit = fields.Datetime.now() - self._get_timeout()
+        return [
+            "|",
+            "&",
+            ("state", "=", "pending"),
+            ("create_date", "<", limit),
+            "&",
+            ("state", "=", "running"),
+            ("date_started", "<", limit),
+        ]
+
+    def _fail_stale(self):
+        """Mark given jobs as failed: they will never complete.
+
+        Jobs run in the memory of the worker: they are lost when it is stopped
+        (eg: restarted after `limit_request` requests or killed by a limit).
+        """
+        if self:
+            _logger.warning("Endpoint jobs %s did not complete in time", self.ids)
+        self.write(
+            {
+                "state": "failed",
+                "date_done": fields.Datetime.now(),
+                "result_status": 504,
+                "error": _("The job did not complete in time."),
+            }
+        )
+
+    @api.autovacuum
+    def _gc_jobs(self):
+        self.sudo().search(self._get_stale_domain())._fail_stale()
+        limit = fields.Datetime.now() - self._gc_delay
+        self.sudo().search(
+            [("state", "in", ("done", "failed")), ("date_done", "<", limit)]
+        ).unlink()
@@ -2,17 +2,42 @@
 # @author: Simone Orsi <simone.orsi@camptocamp.com>
 # License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
 
+import hashlib
+import json
+import signal
 import textwrap
+import threading
+from contextlib import contextmanager
 from functools import partial
+from types import MappingProxyType
+from weakref import WeakKeyDictionary
 
+import psycopg2
 import werkzeug
 
 from odoo import _, api, exceptions, fields, http, models
 from odoo.tools import safe_eval
+from odoo.tools.lru import LRU
 
 from odoo.addons.rpc_helper.decorator import disable_rpc
 
+from .. import utils
 from ..controllers.main import EndpointController
+from ..metrics import EndpointMetrics
+
+# Checked and compiled code snippets by (dbname, model, id, snippet digest)
+_CODE_SNIPPET_CACHE = LRU(1024)
+# Validators of request schemas by (dbname, model, id, schema digest)
+_REQUEST_VALIDATOR_CACHE = LRU(1024)
+# Static part of the evaluation context of code snippets by model class
+_EVAL_CONTEXT_BASE_CACHE = WeakKeyDictionary()
+
+
+class _ExecTimeout(BaseException):
+    """Max execution time exceeded.
+
+    Not an `Exception` to not be swallowed by the code snippet.
+    """
 
 
 @disable_rpc()  # Block ALL RPC calls
@@ -32,9 +57,63 @@ class EndpointMixin(models.AbstractModel):
         default=lambda self: self._default_code_snippet_docs(),
     )
     exec_as_user_id = fields.Many2one(comodel_name="res.users")
+    cache_ttl = fields.Integer(
+        string="Cache TTL",
+        help="Cache responses of GET requests for the given number of seconds. "
+        "Leave empty to disable the cache.",
+    )
+    cache_scope = fields.Selection(
+        selection="_selection_cache_scope",
+        default="user",
+        help="Public: the same response is shared by all users.\n"
+        "Per user: responses are cached for each user.",
+    )
+    cache_key_params = fields.Char(
+        help="Comma separated list of query parameters making up the cache key. "
+        "Leave empty to use all of them.",
+    )
+
+    compress_min_size = fields.Integer(
+        string="Compression threshold (bytes)",
+        help="Compress responses bigger than the given number of bytes "
+        "w/ the best encoding accepted by the client (gzip, or brotli "
+        "when the python package `brotli` is installed).\n"
+        "Leave empty to disable compression.",
+    )
+
+    request_schema = fields.Text(
+        help="JSON schema validating request data: "
+        "the JSON body or, for other content types, the request parameters.\n"
+        "Requests not matching the schema are rejected "
+        "w/ `400 Bad Request` before calling the endpoint.\n"
+        "Requires the python package `jsonschema`.",
+    )
+
+    max_statement_time = fields.Integer(
+        string="Max SQL statement time (ms)",
+        help="Cancel SQL queries of the code lasting more than "
+        "the given number of milliseconds and reply `503 Service Unavailable`.\n"
+        "Leave empty to disable.",
+    )
+    max_exec_time = fields.Float(
+        string="Max execution time (s)",
+        help="Stop the code running for more than the given number of seconds "
+        "and reply `504 Gateway Timeout`.\n"
+        "Python code cannot be stopped while a SQL query is running: "
+        "set a max SQL statement time as well.\n"
+        "Only enforced for requests handled by the main thread "
+        "(eg: by workers in multi-process mode).\n"
+        "Leave empty to disable.",
+    )
 
     def _selection_exec_mode(self):
-        return [("code", "Execute code")]
+        return [
+            ("code", "Execute code"),
+            ("code_async", "Execute code asynchronously"),
+        ]
+
+    def _selection_cache_scope(self):
+        return [("public", "Public"), ("user", "Per user")]
 
     def _compute_code_snippet_docs(self):
         for rec in self:
@@ -55,6 +134,33 @@ class EndpointMixin(models.AbstractModel):
                 _("Exec mode is set to `Code`: you must provide a piece of code")
             )
 
+    @api.constrains("request_schema")
+    def _check_request_schema(self):
+        for rec in self:
+            if not rec.request_schema:
+                continue
+            if utils.jsonschema is None:
+                raise exceptions.UserError(
+                    _("Install the python package `jsonschema` to use request schemas.")
+                )
+            try:
+                # Compile it right away to not do it on the 1st request
+                rec._get_request_validator()
+            except (ValueError, utils.jsonschema.SchemaError) as err:
+                raise exceptions.UserError(
+                    _("Invalid request schema for `%(route)s`: %(error)s")
+                    % {"route": rec.route, "error": err}
+                ) from err
+
+    @api.constrains("read_only", "exec_mode")
+    def _check_read_only(self):
+        for rec in self:
+            if rec.read_only and rec.exec_mode == "code_async":
+                # Jobs are recorded when handling the request
+                raise exceptions.UserError(
+                    _("Asynchronous endpoints cannot be read-only.")
+                )
+
     @api.constrains("auth_type")
     def _check_auth(self):
         for rec in self:
@@ -70,6 +176,8 @@ class EndpointMixin(models.AbstractModel):
         * env
         * endpoint
         * request
+        * request_body
+        * route_params
         * datetime
         * dateutil
         * time
@@ -86,6 +194,22 @@ class EndpointMixin(models.AbstractModel):
         * status_code
 
         which are all optional.
+        Dates, datetimes and decimals in ``payload`` are serialized out of the box.
+
+        Values of the converters of the route (eg: ``/order/<int:id>``)
+        are available in ``route_params`` (eg: ``route_params["id"]``).
+
+        To read big request bodies w/o loading them in memory, use ``request_body``:
+
+        * ``request_body.iter_chunks()``: raw chunks of bytes
+        * ``request_body.iter_lines()``: decoded lines (eg: CSV)
+        * ``request_body.iter_ndjson()``: values of a newline delimited JSON body
+        * ``request_body.iter_json_items()``: items of a JSON array body
+
+        To stream big payloads, provide an iterable (eg: a generator)
+        as ``payload_iter`` instead of ``payload``.
+        Items are sent as a JSON array or, w/ ``payload_format = "ndjson"``,
+        as newline delimited JSON.
         """
 
     def _get_code_snippet_eval_context(self, request):
@@ -93,11 +217,39 @@ class EndpointMixin(models.AbstractModel):
 
         :returns: dict -- evaluation context given to safe_eval
         """
+        eval_ctx = dict(self._get_code_snippet_eval_context_base())
+        eval_ctx.update(
+            {
+                "env": self.env,
+                "user": self.env.user,
+                "endpoint": self,
+                "request": request,
+                "request_body": utils.RequestBody(request.httprequest),
+                "route_params": self._get_route_params(),
+            }
+        )
+        return eval_ctx
+
+    def _get_code_snippet_eval_context_base(self):
+        """Return the static part of the evaluation context.
+
+        Built once per model class, hence shared by all requests:
+        it's read-only. To add static values,
+        override `_make_code_snippet_eval_context_base`.
+        """
+        cls = type(self)
+        base = _EVAL_CONTEXT_BASE_CACHE.get(cls)
+        if base is None:
+            base = MappingProxyType(self._make_code_snippet_eval_context_base())
+            _EVAL_CONTEXT_BASE_CACHE[cls] = base
+        return base
+
+    def _make_code_snippet_eval_context_base(self):
+        """Build the values of the context not depending on the request.
+
+        :returns: dict
+        """
         return {
-            "env": self.env,
-            "user": self.env.user,
-            "endpoint": self,
-            "request": request,
             "datetime": safe_eval.datetime,
             "dateutil": safe_eval.dateutil,
             "time": safe_eval.time,
@@ -115,8 +267,12 @@ class EndpointMixin(models.AbstractModel):
         if not self._code_snippet_valued():
             return {}
         eval_ctx = self._get_code_snippet_eval_context(request)
-        snippet = self.code_snippet
-        safe_eval.safe_eval(snippet, eval_ctx, mode="exec", nocopy=True)
+        code = self._get_code_snippet_compiled()
+        # Same as `safe_eval.safe_eval` but w/ the code already checked and compiled
+        safe_eval.check_values(eval_ctx)
+        eval_ctx["__builtins__"] = safe_eval._BUILTINS
+        with self._exec_limits():
+            safe_eval.unsafe_eval(code, eval_ctx)
         result = eval_ctx.get("result")
         if not isinstance(result, dict):
             raise exceptions.UserError(
@@ -124,6 +280,121 @@ class EndpointMixin(models.AbstractModel):
             )
         return result
 
+    @contextmanager
+    def _exec_limits(self):
+        """Enforce max SQL statement time and max execution time.
+
+        Changes are rolled back when a limit is exceeded.
+        """
+        statement_time = self.max_statement_time
+        if not statement_time and not self.max_exec_time:
+            yield
+            return
+        cr = self.env.cr
+        if statement_time:
+            # Restore the timeout in place, not the default one, once done
+            cr.execute("SHOW statement_timeout")
+            previous_statement_time = cr.fetchone()[0]
+            cr.execute("SET LOCAL statement_timeout = %s", (statement_time,))
+        try:
+            with cr.savepoint(), self._exec_timer():
+                yield
+        except psycopg2.extensions.QueryCanceledError as err:
+            self._logger.error("%s: max SQL statement time exceeded", self.route)
+            self._count_timeout("statement")
+            raise werkzeug.exceptions.ServiceUnavailable() from err
+        finally:
+            if statement_time:
+                cr.execute(
+                    "SET LOCAL statement_timeout = %s", (previous_statement_time,)
+                )
+
+    @contextmanager
+    def _exec_timer(self):
+        """Interrupt the execution once the max execution time is exceeded."""
+        timeout = self.max_exec_time
+        if not timeout or threading.current_thread() is not threading.main_thread():
+            # Signals are handled by the main thread only
+            yield
+            return
+
+        def on_timeout(signum, frame):
+            raise _ExecTimeout()
+
+        previous_handler = signal.signal(signal.SIGALRM, on_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+        try:
+            try:
+                yield
+            finally:
+                # Cancel the timer while `_ExecTimeout` can still be caught:
+                # the alarm may go off right before it is cancelled.
+                signal.setitimer(signal.ITIMER_REAL, 0)
+        except _ExecTimeout as err:
+            self._logger.error("%s: max execution time exceeded", self.route)
+            self._count_timeout("exec")
+            raise werkzeug.exceptions.GatewayTimeout() from err
+        finally:
+            signal.signal(signal.SIGALRM, previous_handler)
+
+    def _count_timeout(self, kind):
+        EndpointMetrics.metrics_for(self.env.cr.dbname).inc(
+            "endpoint_timeouts_total", (("route", self.route), ("kind", kind))
+        )
+
+    def _validate_exec__code_async(self):
+        self._validate_exec__code()
+
+    def _handle_exec__code_async(self, request):
+        """Record the request and execute the code in background.
+
+        Reply `202 Accepted` w/ the URL where the result can be retrieved.
+        """
+        if self.env.context.get("endpoint_job_run"):
+            # Running the job
+            return self._handle_exec__code(request)
+        job = self.env["endpoint.job"]._create_from_request(self, request)
+        job._schedule()
+        status_url = job._get_status_url()
+        return {
+            "status_code": 202,
+            "payload": job._get_status_payload(),
+            "headers": {"Location": status_url},
+        }
+
+    def _code_snippet_cache_key(self):
+        digest = hashlib.sha1((self.code_snippet or "").encode()).hexdigest()
+        return (self.env.cr.dbname, self._name, self.id, digest)
+
+    def _get_code_snippet_compiled(self):
+        """Return the code object of the snippet.
+
+        Checking opcodes and compiling is done once per process
+        and per version of the snippet.
+        """
+        key = self._code_snippet_cache_key()
+        code = _CODE_SNIPPET_CACHE.get(key)
+        if code is None:
+            code = safe_eval.test_expr(
+                self.code_snippet, safe_eval._SAFE_OPCODES, mode="exec"
+            )
+            _CODE_SNIPPET_CACHE[key] = code
+        return code
+
+    def _code_snippet_cache_warmup(self):
+        for rec in self:
+            if rec.exec_mode not in ("code", "code_async"):
+                continue
+            if not rec._code_snippet_valued():
+                continue
+            try:
+                rec._get_code_snippet_compiled()
+            except Exception as err:
+                # Let the request fail and report the error
+                self._logger.warning(
+                    "Cannot compile code snippet for `%s`: %s", rec.route, err
+                )
+
     def _code_snippet_valued(self):
         snippet = self.code_snippet or ""
         return bool(
@@ -137,6 +408,53 @@ class EndpointMixin(models.AbstractModel):
     def _default_endpoint_handler(self):
         return partial(EndpointController().auto_endpoint, self.route)
 
+    def _register_controllers(self, init=False):
+        # Not in `_register_controller`: rule hooks must not be overridden
+        # to keep lazy loading available (see `_endpoint_route_lazy_load`).
+        super()._register_controllers(init=init)
+        if not init:
+            # On init, defer compilation to the 1st call to not slow down startup.
+            self._code_snippet_cache_warmup()
+
+    def write(self, vals):
+        res = super().write(vals)
+        if "code_snippet" in vals:
+            self._code_snippet_cache_warmup()
+        self._response_cache_invalidate()
+        return res
+
+    def _response_cache_key(self, request):
+        """Return the key identifying the cached response for current request.
+
+        `write_date` makes sure other workers do not serve outdated responses
+        once the endpoint has been modified (see `_response_cache_invalidate`
+        for the current worker).
+
+        :return: a tuple or None if the response must not be cached
+        """
+        if not self.cache_ttl or request.httprequest.method != "GET":
+            return None
+        args = request.httprequest.args
+        param_names = self._get_cache_key_params() or sorted(args.keys())
+        params = tuple((name, tuple(args.getlist(name))) for name in param_names)
+        rec_key = (self.env.cr.dbname, self._name, self.id)
+        return rec_key + (
+            self.write_date,
+            self.env.uid if self.cache_scope != "public" else None,
+            tuple(sorted(self._get_route_params().items())),
+            params,
+        )
+
+    def _get_cache_key_params(self):
+        return [
+            x.strip() for x in (self.cache_key_params or "").split(",") if x.strip()
+        ]
+
+    def _response_cache_invalidate(self):
+        EndpointController._response_cache_drop(
+            {(rec.env.cr.dbname, rec._name, rec.id) for rec in self}
+        )
+
     def _validate_request(self, request):
         http_req = request.httprequest
         if self.request_method and self.request_method != http_req.method:
@@ -148,6 +466,49 @@ class EndpointMixin(models.AbstractModel):
         ):
             self._logger.error("_validate_request: UnsupportedMediaType")
             raise werkzeug.exceptions.UnsupportedMediaType()
+        if self.request_schema:
+            self._validate_request_schema(request)
+
+    def _validate_request_schema(self, request):
+        validator = self._get_request_validator()
+        data = self._get_request_data(request)
+        error = utils.json_validation_error(validator, data)
+        if error is not None:
+            path = "/".join(str(x) for x in error.absolute_path)
+            self._logger.error("_validate_request: BadRequest (schema)")
+            raise werkzeug.exceptions.BadRequest(
+                "{}: {}".format(path, error.message) if path else error.message
+            )
+
+    def _get_request_data(self, request):
+        """Return request data to validate against the request schema."""
+        http_req = request.httprequest
+        if http_req.mimetype == "application/json":
+            try:
+                return json.loads(http_req.get_data() or b"null")
+            except ValueError as err:
+                raise werkzeug.exceptions.BadRequest("Invalid JSON body") from err
+        return http_req.values.to_dict()
+
+    def _request_validator_cache_key(self):
+        digest = hashlib.sha1((self.request_schema or "").encode()).hexdigest()
+        return (self.env.cr.dbname, self._name, self.id, digest)
+
+    def _get_request_validator(self):
+        """Return the validator of the request schema.
+
+        The schema is checked and compiled once per process
+        and per version of the schema.
+        """
+        if utils.jsonschema is None:
+            self._logger.error("Cannot validate request: `jsonschema` not installed")
+            raise werkzeug.exceptions.InternalServerError()
+        key = self._request_validator_cache_key()
+        validator = _REQUEST_VALIDATOR_CACHE.get(key)
+        if validator is None:
+            validator = utils.make_json_validator(json.loads(self.request_schema))
+            _REQUEST_VALIDATOR_CACHE[key] = validator
+        return validator
 
     def _get_handler(self):
         try:
@@ -175,7 +536,48 @@ class EndpointMixin(models.AbstractModel):
 
     @api.model
     def _find_endpoint(self, endpoint_route):
-        return self.sudo().search(self._find_endpoint_domain(endpoint_route), limit=1)
+        return self._match_endpoint(endpoint_route)[0]
+
+    @api.model
+    def _match_endpoint(self, endpoint_route):
+        """Find the endpoint matching given route or path.
+
+        When a path is given (eg: `/order/1`) and it matches
+        a route w/ converters (eg: `/order/<int:id>`),
+        values of the converters are extracted as route params.
+
+        :return: tuple `(endpoint, route params)`
+        """
+        # Routing rules are indexed in the registry: no need to query the DB
+        registry = self._endpoint_registry
+        rule = registry.get_rule_by_route(endpoint_route)
+        params = {}
+        if rule is None:
+            rule, params = registry.match(endpoint_route)
+        if rule:
+            model, res_id = self._endpoint_registry_parse_key(rule.key)
+            if model == self._name:
+                # The registry is not transactional: it might be outdated
+                # (eg: record created or route changed in a rolled back transaction)
+                endpoint = self.sudo().browse(res_id).exists()
+                if endpoint.route == rule.route:
+                    return endpoint, params
+        endpoint = self.sudo().search(
+            self._find_endpoint_domain(endpoint_route), limit=1
+        )
+        return endpoint, {}
+
+    def _get_route_param_names(self):
+        """Return the names of the converters of the route."""
+        return [
+            variable
+            for converter, __, variable in werkzeug.routing.parse_rule(self.route or "")
+            if converter is not None
+        ]
+
+    def _get_route_params(self):
+        """Return route params of the current request."""
+        return self.env.context.get("endpoint_route_params") or {}
 
     def _find_endpoint_domain(self, endpoint_route):
         return [("route", "=", endpoint_route)]
@@ -1,2 +1,3 @@
 from . import test_endpoint
 from . import test_endpoint_controller
+from . import test_benchmark
@@ -0,0 +1,102 @@
+# Copyright 2021 Camptocamp SA
+# @author: Simone Orsi <simone.orsi@camptocamp.com>
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
+
+import logging
+import random
+from functools import partial
+from unittest import mock
+
+from odoo.tests.common import tagged
+
+from odoo.addons.endpoint_route_handler import registry as registry_module
+from odoo.addons.endpoint_route_handler.registry import EndpointRegistry
+from odoo.addons.endpoint_route_handler.tests.benchmark import BenchmarkMixin
+
+from ..controllers.main import EndpointController
+from .common import CommonEndpoint
+
+_logger = logging.getLogger(__name__)
+
+
+def _endpoint_vals(i):
+    return {
+        "name": "Bench {}".format(i),
+        "route": "/bench/dispatch/{}".format(i),
+        "request_method": "GET",
+        "exec_mode": "code",
+        "code_snippet": "result = {'response': Response('ok')}",
+    }
+
+
+@tagged("-standard", "-at_install", "post_install", "endpoint_benchmark")
+class TestBenchmarkDispatch(BenchmarkMixin, CommonEndpoint):
+
+    _benchmark_name = "endpoint_dispatch"
+    _benchmark_module = "endpoint"
+
+    def test_benchmark(self):
+        controller = EndpointController()
+        model = self.env["endpoint.endpoint"]
+        created = 0
+        for size in sorted(self._benchmark_sizes()):
+            # Keep endpoints of previous sizes and add the missing ones
+            model.create([_endpoint_vals(i) for i in range(created, size)])
+            created = size
+            routes = [
+                "/bench/dispatch/{}".format(i)
+                for i in random.sample(range(size), min(100, size))
+            ]
+            with self._get_mocked_request(httprequest={"method": "GET"}):
+                responses = self._bench(
+                    "auto_endpoint_dispatch",
+                    size,
+                    lambda: [controller.auto_endpoint(route) for route in routes],
+                    per_call=len(routes),
+                )
+            self.assertEqual(responses[0].data, b"ok")
+
+
+@tagged("-standard", "-at_install", "post_install", "endpoint_benchmark")
+class TestBenchmarkStartup(BenchmarkMixin, CommonEndpoint):
+
+    _benchmark_name = "endpoint_startup"
+    _benchmark_module = "endpoint"
+
+    def _load(self, loader, model):
+        registry = EndpointRegistry()
+        with mock.patch.dict(
+            registry_module._REGISTRY_BY_DB, {model.env.cr.dbname: registry}
+        ):
+            loader(model)
+        return registry
+
+    def _load_eager(self, model):
+        model.invalidate_cache()
+        model.search([("active", "=", True)])._register_controllers(init=True)
+
+    def _load_lazy(self, model):
+        model._register_controllers_lazy()
+
+    def test_benchmark(self):
+        model = self.env["endpoint.endpoint"]
+        created = 0
+        for size in sorted(self._benchmark_sizes()):
+            model.create([_endpoint_vals(i) for i in range(created, size)])
+            created = size
+            timings = {}
+            for mode in ("eager", "lazy"):
+                registry = self._bench(
+                    "startup_" + mode,
+                    size,
+                    partial(self._load, getattr(self, "_load_" + mode), model),
+                    repeat=3,
+                )
+                self.assertGreaterEqual(len(registry.get_rules()), size)
+                timings[mode] = self._benchmark_results[-1]["median"]
+            _logger.info(
+                "BENCHMARK lazy startup [%s]: %.3fs saved (%.1fx faster)",
+                size,
+                timings["eager"] - timings["lazy"],
+                timings["eager"] / (timings["lazy"] or 1e-9),
+            )
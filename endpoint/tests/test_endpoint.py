@@ -2,15 +2,28 @@
 # @author: Simone Orsi <simone.orsi@camptocamp.com>
 # License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
 
+import datetime
+import gzip
 import json
 import textwrap
+import threading
+import unittest
+from decimal import Decimal
+from unittest import mock
 
 import psycopg2
 import werkzeug
+from werkzeug.http import parse_accept_header
 
-from odoo import exceptions
+from odoo import exceptions, fields
+from odoo.tools import config, safe_eval
 from odoo.tools.misc import mute_logger
 
+from odoo.addons.endpoint_route_handler import registry as registry_module
+from odoo.addons.endpoint_route_handler.registry import EndpointRegistry
+
+from .. import utils
+from ..metrics import EndpointMetrics
 from .common import CommonEndpoint
 
 
@@ -31,6 +44,41 @@ class TestEndpoint(CommonEndpoint):
                 }
             )
 
+    def test_endpoint_unique_across_models(self):
+        model = self.env["endpoint.endpoint"]
+        registry = EndpointRegistry()
+        registry.add_or_update_rule(
+            registry.make_rule("fake.endpoint:1", "/fake/clash", None, {}, "hash")
+        )
+        vals = {
+            "request_method": "GET",
+            "exec_mode": "code",
+            "code_snippet": "result = {}",
+        }
+        dbname = self.env.cr.dbname
+        with mock.patch.dict(
+            registry_module._REGISTRY_BY_DB, {dbname: registry}
+        ), mock.patch.object(
+            type(model),
+            "_get_endpoint_route_consumer_models",
+            return_value=["endpoint.endpoint", "fake.endpoint"],
+        ), mock.patch.object(
+            type(model), "_find_clashing_route_models_db", return_value=set()
+        ) as mocked:
+            with self.assertRaisesRegex(
+                exceptions.UserError, r"Found in model\(s\): fake.endpoint"
+            ):
+                model.create(dict(vals, name="Clash", route="/fake/clash"))
+            mocked.assert_not_called()
+            # Not in the registry: checked in the DB once for all the routes
+            model.create(
+                [
+                    dict(vals, name="No clash 1", route="/fake/1"),
+                    dict(vals, name="No clash 2", route="/fake/2"),
+                ]
+            )
+            mocked.assert_called_once_with(["fake.endpoint"], ["/fake/1", "/fake/2"])
+
     def test_endpoint_validation(self):
         with self.assertRaisesRegex(
             exceptions.UserError, r"you must provide a piece of code"
@@ -62,11 +110,233 @@ class TestEndpoint(CommonEndpoint):
         ):
             self.endpoint.request_method = "POST"
 
+    @unittest.skipIf(utils.jsonschema is None, "jsonschema not installed")
+    @mute_logger("endpoint.endpoint")
+    def test_endpoint_validate_request_schema(self):
+        schema = {
+            "type": "object",
+            "properties": {"qty": {"type": "integer"}},
+            "required": ["qty"],
+        }
+        endpoint = self.endpoint.copy(
+            {
+                "route": "/schema",
+                "request_method": "POST",
+                "request_content_type": "application/json",
+                "request_schema": json.dumps(schema),
+            }
+        )
+        validator = endpoint._get_request_validator()
+        # Compiled once
+        self.assertIs(endpoint._get_request_validator(), validator)
+        headers = [("Content-type", "application/json")]
+        httprequest = {
+            "method": "POST",
+            "content_type": "application/json",
+            "mimetype": "application/json",
+        }
+        for body, error in (
+            (b'{"qty": 1}', None),
+            (b'{"qty": "1"}', r"qty: '1' is not of type 'integer'"),
+            (b"{}", r"'qty' is a required property"),
+            (b"{", r"Invalid JSON body"),
+        ):
+            httprequest["get_data"] = lambda body=body: body
+            with self._get_mocked_request(
+                httprequest=httprequest, extra_headers=headers
+            ) as req:
+                if error is None:
+                    endpoint._validate_request(req)
+                    continue
+                with self.assertRaisesRegex(werkzeug.exceptions.BadRequest, error):
+                    endpoint._validate_request(req)
+        # Invalidated on write
+        schema["properties"]["qty"]["type"] = "string"
+        endpoint.request_schema = json.dumps(schema)
+        self.assertIsNot(endpoint._get_request_validator(), validator)
+        with self.assertRaisesRegex(exceptions.UserError, "Invalid request schema"):
+            endpoint.request_schema = '{"type": "nope"}'
+
     def test_endpoint_find(self):
         self.assertEqual(
             self.env["endpoint.endpoint"]._find_endpoint("/demo/one"), self.endpoint
         )
 
+    def test_endpoint_find_from_registry(self):
+        model = self.env["endpoint.endpoint"]
+        with mock.patch.object(type(model), "search") as mocked:
+            self.assertEqual(model._find_endpoint("/demo/one"), self.endpoint)
+            mocked.assert_not_called()
+        # Fallback to search when the route is unknown to the registry
+        registry = self.endpoint._endpoint_registry
+        key = self.endpoint._endpoint_registry_unique_key()
+        with mock.patch.dict(registry._rules_by_route, clear=True):
+            self.assertIsNone(registry.get_rule_by_route("/demo/one"))
+            self.assertEqual(model._find_endpoint("/demo/one"), self.endpoint)
+        self.assertEqual(registry.get_rule_by_route("/demo/one").key, key)
+
+    def test_endpoint_match_outdated_registry(self):
+        model = self.env["endpoint.endpoint"]
+        # Changes w/o the ORM: the registry is not aware of them
+        endpoint = self.endpoint.copy({"route": "/demo/deleted"})
+        self.env.cr.execute(
+            "DELETE FROM endpoint_endpoint WHERE id = %s", (endpoint.id,)
+        )
+        self.env.cr.execute(
+            "UPDATE endpoint_endpoint SET route = '/demo/moved' WHERE id = %s",
+            (self.endpoint.id,),
+        )
+        model.invalidate_cache()
+        self.assertEqual(model._match_endpoint("/demo/deleted"), (model, {}))
+        self.assertEqual(model._match_endpoint("/demo/one"), (model, {}))
+
+    def test_endpoint_match_route_params(self):
+        model = self.env["endpoint.endpoint"]
+        endpoint = self.endpoint.copy({"route": "/demo/order/<int:order_id>"})
+        self.assertEqual(endpoint._get_route_param_names(), ["order_id"])
+        with mock.patch.object(type(model), "search") as mocked:
+            self.assertEqual(
+                model._match_endpoint("/demo/order/<int:order_id>"), (endpoint, {})
+            )
+            self.assertEqual(
+                model._match_endpoint("/demo/order/3"), (endpoint, {"order_id": 3})
+            )
+            self.assertEqual(model._find_endpoint("/demo/order/3"), endpoint)
+            mocked.assert_not_called()
+        self.assertFalse(model._find_endpoint("/demo/order/foo"))
+
+    def test_endpoint_code_eval_route_params(self):
+        self.endpoint.code_snippet = "result = {'payload': route_params}"
+        with self._get_mocked_request() as req:
+            result = self.endpoint._handle_request(req)
+            self.assertEqual(result["payload"], {})
+            result = self.endpoint.with_context(
+                endpoint_route_params={"order_id": 3}
+            )._handle_request(req)
+            self.assertEqual(result["payload"], {"order_id": 3})
+
+    def test_endpoint_code_eval_context(self):
+        base = self.endpoint._get_code_snippet_eval_context_base()
+        # Built once
+        self.assertIs(self.endpoint._get_code_snippet_eval_context_base(), base)
+        with self.assertRaises(TypeError):
+            base["env"] = self.env
+        with self._get_mocked_request() as req:
+            eval_ctx = self.endpoint._get_code_snippet_eval_context(req)
+            self.assertIs(eval_ctx["request"], req)
+        self.assertIs(eval_ctx["werkzeug"], base["werkzeug"])
+        self.assertEqual(eval_ctx["endpoint"], self.endpoint)
+        self.assertNotIn("env", base)
+
+    def test_endpoint_code_async(self):
+        endpoint = self.endpoint.copy(
+            {
+                "route": "/async/<int:order_id>",
+                "exec_mode": "code_async",
+                "code_snippet": textwrap.dedent(
+                    """
+                    result = {
+                        "payload": {
+                            "params": request.params,
+                            "route_params": route_params,
+                            "user": user.login,
+                        },
+                        "status_code": 201,
+                    }
+                    """
+                ),
+            }
+        ).with_context(endpoint_route_params={"order_id": 3})
+        httprequest = {
+            "method": "GET",
+            "path": "/async/3",
+            "query_string": b"foo=bar",
+            "get_data": lambda: b"",
+        }
+        headers = {
+            "Content-Type": "text/plain",
+            "Cookie": "session_id=secret",
+            "Authorization": "Bearer secret",
+            "API-KEY": "secret",
+            "X-Api-Key": "secret",
+            "X-Request-Id": "42",
+        }
+        with self._get_mocked_request(
+            httprequest=httprequest, extra_headers=headers
+        ) as req:
+            result = endpoint._handle_request(req)
+        self.assertEqual(result["status_code"], 202)
+        job = self.env["endpoint.job"]._find_by_token(result["payload"]["job"])
+        self.assertEqual(job.state, "pending")
+        # Credentials are not stored
+        self.assertEqual(
+            json.loads(job.request_headers),
+            [["Content-Type", "text/plain"], ["X-Request-Id", "42"]],
+        )
+        self.assertNotIn("secret", job.request_headers)
+        self.assertEqual(result["headers"]["Location"], job._get_status_url())
+        self.assertEqual(job.user_id, self.env.user)
+        with mock.patch.object(type(self.env.cr), "commit") as mocked_commit:
+            job._run()
+            mocked_commit.assert_called_once()
+        self.assertEqual(job.state, "done")
+        self.assertEqual(job.result_status, 201)
+        self.assertEqual(
+            json.loads(job._get_result_body()),
+            {
+                "params": {"foo": "bar"},
+                "route_params": {"order_id": 3},
+                "user": self.env.user.login,
+            },
+        )
+
+    @mute_logger("endpoint.endpoint")
+    def test_endpoint_code_async_failed(self):
+        endpoint = self.endpoint.copy(
+            {
+                "route": "/async/fail",
+                "exec_mode": "code_async",
+                "code_snippet": "raise exceptions.UserError('Nope')",
+            }
+        )
+        httprequest = {
+            "method": "GET",
+            "path": "/async/fail",
+            "query_string": b"",
+            "get_data": lambda: b"",
+        }
+        with self._get_mocked_request(httprequest=httprequest) as req:
+            result = endpoint._handle_request(req)
+        job = self.env["endpoint.job"]._find_by_token(result["payload"]["job"])
+        with mock.patch.object(type(self.env.cr), "commit"):
+            job._run()
+        self.assertEqual(job.state, "failed")
+        self.assertEqual(job.result_status, 400)
+        self.assertEqual(job._get_status_payload()["status"], "failed")
+
+    @mute_logger("odoo.addons.endpoint.models.endpoint_job")
+    def test_endpoint_job_stale(self):
+        vals = {
+            "res_model": self.endpoint._name,
+            "res_id": self.endpoint.id,
+            "user_id": self.env.uid,
+        }
+        jobs = self.env["endpoint.job"].create(
+            [dict(vals, token=str(i)) for i in range(3)]
+        )
+        self.env.cr.execute(
+            "UPDATE endpoint_job SET create_date = now() - interval '2 hours' "
+            "WHERE id IN %s",
+            (tuple(jobs[:2].ids),),
+        )
+        jobs.invalidate_cache()
+        jobs[1].write({"state": "running", "date_started": fields.Datetime.now()})
+        self.env["endpoint.job"]._gc_jobs()
+        # Pending for too long, still running, just created
+        self.assertEqual(jobs.mapped("state"), ["failed", "running", "pending"])
+        self.assertEqual(jobs[0].result_status, 504)
+        self.assertEqual(jobs[0]._get_status_payload()["status"], "failed")
+
     def test_endpoint_code_eval_full_response(self):
         with self._get_mocked_request() as req:
             result = self.endpoint._handle_request(req)
@@ -74,6 +344,19 @@ class TestEndpoint(CommonEndpoint):
         self.assertEqual(resp.status, "200 OK")
         self.assertEqual(resp.data, b"ok")
 
+    def test_endpoint_code_eval_compiled_once(self):
+        with mock.patch.object(
+            safe_eval, "test_expr", wraps=safe_eval.test_expr
+        ) as mocked:
+            # Compiled on save
+            self.endpoint.code_snippet = "result = {'response': Response('cached')}"
+            self.assertEqual(mocked.call_count, 1)
+            with self._get_mocked_request() as req:
+                self.endpoint._handle_request(req)
+                result = self.endpoint._handle_request(req)
+            self.assertEqual(mocked.call_count, 1)
+        self.assertEqual(result["response"].data, b"cached")
+
     def test_endpoint_code_eval_free_vals(self):
         self.endpoint.write(
             {
@@ -92,6 +375,74 @@ class TestEndpoint(CommonEndpoint):
         payload = result["payload"]
         self.assertEqual(json.loads(payload), {"a": 1, "b": 2})
 
+    def test_endpoint_read_only(self):
+        # Not committed: the read-only cursor runs the stored code snippet
+        self.endpoint.code_snippet = "result = {'payload': 'not committed'}"
+        with self._get_mocked_request() as req:
+            with self.endpoint._endpoint_read_only_env() as env:
+                self.assertIsNot(env.cr, self.env.cr)
+                result = self.endpoint.with_env(env)._handle_request(req)
+        self.assertEqual(result["response"].data, b"ok")
+        self.assertEqual(
+            self.endpoint.code_snippet, "result = {'payload': 'not committed'}"
+        )
+        with self.assertRaisesRegex(exceptions.UserError, "cannot be read-only"):
+            self.endpoint.write({"read_only": True, "exec_mode": "code_async"})
+
+    def _get_timeouts_count(self, kind):
+        metrics = EndpointMetrics.metrics_for(self.env.cr.dbname)
+        labels = (("route", self.endpoint.route), ("kind", kind))
+        return metrics._counters.get(("endpoint_timeouts_total", labels), 0)
+
+    @mute_logger("endpoint.endpoint", "odoo.sql_db")
+    def test_endpoint_max_statement_time(self):
+        # A timeout set by the caller is restored, not reset to the default
+        self.env.cr.execute("SET LOCAL statement_timeout = '42s'")
+        count = self._get_timeouts_count("statement")
+        self.endpoint.write(
+            {
+                "max_statement_time": 10,
+                "code_snippet": "env.cr.execute('SELECT pg_sleep(1)')",
+            }
+        )
+        with self._get_mocked_request() as req:
+            with self.assertRaises(werkzeug.exceptions.ServiceUnavailable):
+                self.endpoint._handle_request(req)
+        self.assertEqual(self._get_timeouts_count("statement"), count + 1)
+        # The transaction can still be used and the timeout is restored
+        self.env.cr.execute("SHOW statement_timeout")
+        self.assertEqual(self.env.cr.fetchone()[0], "42s")
+
+    @unittest.skipIf(
+        threading.current_thread() is not threading.main_thread(),
+        "Max execution time is enforced only in the main thread",
+    )
+    @mute_logger("endpoint.endpoint")
+    def test_endpoint_max_exec_time(self):
+        count = self._get_timeouts_count("exec")
+        self.endpoint.write(
+            {
+                "max_exec_time": 0.1,
+                "code_snippet": textwrap.dedent(
+                    """
+                    env.user.name = "Changed"
+                    while True:
+                        try:
+                            time.sleep(0.01)
+                        except Exception:
+                            pass
+                    """
+                ),
+            }
+        )
+        name = self.env.user.name
+        with self._get_mocked_request() as req:
+            with self.assertRaises(werkzeug.exceptions.GatewayTimeout):
+                self.endpoint._handle_request(req)
+        self.assertEqual(self._get_timeouts_count("exec"), count + 1)
+        # Changes are rolled back
+        self.assertEqual(self.env.user.name, name)
+
     @mute_logger("endpoint.endpoint")
     def test_endpoint_validate_request(self):
         endpoint = self.endpoint.copy(
@@ -196,3 +547,233 @@ class TestEndpoint(CommonEndpoint):
         endpoint.active = False
         self.assertTrue(registry.routing_update_required(http_id))
         self.assertFalse(registry.routing_update_required(fake_2nd_http_id))
+
+    def test_registry_sync(self):
+        registry = self.endpoint._endpoint_registry
+        version = registry.db_version(self.env.cr)
+        endpoint = self.endpoint.copy({"route": "/sync/this"})
+        key = endpoint._endpoint_registry_unique_key()
+        self.assertGreater(registry.db_version(self.env.cr), version)
+        # Simulate a worker that did not see the change
+        other_registry = EndpointRegistry()
+        other_registry._version = version
+        dbname = self.env.cr.dbname
+        with mock.patch.dict(registry_module._REGISTRY_BY_DB, {dbname: other_registry}):
+            self.assertNotIn(key, other_registry._mapping)
+            keys = self.env["endpoint.route.handler"]._endpoint_registry_sync()
+            self.assertIn(key, keys)
+            self.assertEqual(other_registry._mapping[key].route, "/sync/this")
+            # Nothing changed meanwhile
+            self.assertEqual(
+                self.env["endpoint.route.handler"]._endpoint_registry_sync(), []
+            )
+        # Archive it on the 1st worker
+        endpoint.active = False
+        self.assertNotIn(key, registry._mapping)
+        with mock.patch.dict(registry_module._REGISTRY_BY_DB, {dbname: other_registry}):
+            keys = self.env["endpoint.route.handler"]._endpoint_registry_sync()
+            self.assertEqual(keys, [key])
+            self.assertNotIn(key, other_registry._mapping)
+
+    def test_lazy_load_option(self):
+        model = self.env["endpoint.endpoint"]
+        self.assertFalse(model._endpoint_route_lazy_load())
+        with mock.patch.dict(config.options, {"endpoint_route_lazy_load": "1"}):
+            self.assertTrue(model._endpoint_route_lazy_load())
+            # Rules could not be built the way overrides expect
+            with mock.patch.object(
+                type(model), "_get_routing_info", autospec=True
+            ), mute_logger("endpoint.endpoint"):
+                self.assertFalse(model._endpoint_route_lazy_load())
+
+    def test_register_lazy(self):
+        model = self.env["endpoint.endpoint"]
+        registry = EndpointRegistry()
+        dbname = self.env.cr.dbname
+        with mock.patch.dict(registry_module._REGISTRY_BY_DB, {dbname: registry}):
+            count = model._register_controllers_lazy()
+        self.assertEqual(count, model.search_count([]))
+        key = self.endpoint._endpoint_registry_unique_key()
+        rule = registry.get_rule(key)
+        route, routing, endpoint_hash = self.endpoint._get_routing_info()
+        self.assertEqual(rule.route, route)
+        self.assertEqual(rule.routing, routing)
+        self.assertEqual(rule.endpoint_hash, endpoint_hash)
+        self.assertEqual(rule.route_group, self.endpoint.route_group)
+        # The handler is resolved only when needed
+        handler = rule.endpoint.method
+        self.assertIsNone(handler._handler)
+        resolved = handler.resolve(self.env)
+        self.assertEqual(resolved.args, (route,))
+        self.assertIs(handler.resolve(self.env), resolved)
+        # Registering the same record again does not replace the rule
+        with mock.patch.dict(registry_module._REGISTRY_BY_DB, {dbname: registry}):
+            self.endpoint._register_controllers()
+        self.assertIs(registry.get_rule(key), rule)
+
+    def test_register_batch(self):
+        vals = [
+            {
+                "name": "Batch {}".format(i),
+                "route": "/batch/{}".format(i),
+                "request_method": "GET",
+                "exec_mode": "code",
+                "code_snippet": "result = {}",
+            }
+            for i in range(2)
+        ]
+        model_cls = type(self.env["endpoint.endpoint"])
+        register_controller = model_cls._register_controller
+        with mock.patch.object(
+            EndpointRegistry, "notify_changes"
+        ) as mocked, mock.patch.object(
+            model_cls,
+            "_register_controller",
+            autospec=True,
+            side_effect=register_controller,
+        ) as mocked_register:
+            endpoints = self.env["endpoint.endpoint"].create(vals)
+            # Each record goes through the per-record hook...
+            self.assertEqual(mocked_register.call_count, 2)
+            # ...but changes are notified at once
+            self.assertEqual(mocked.call_count, 1)
+            keys = mocked.call_args[0][1]
+            self.assertEqual(
+                sorted(keys),
+                sorted(x._endpoint_registry_unique_key() for x in endpoints),
+            )
+            mocked.reset_mock()
+            endpoints.unlink()
+            self.assertEqual(mocked.call_count, 1)
+            self.assertEqual(len(mocked.call_args[0][1]), 2)
+
+    def test_sized_lru(self):
+        cache = utils.SizedLRU(10)
+        self.assertTrue(cache.set("a", 1, 4))
+        self.assertTrue(cache.set("b", 2, 4))
+        # "b" becomes the least recently used entry
+        self.assertEqual(cache.get("a"), 1)
+        cache.grow("a", 3)
+        self.assertNotIn("b", cache)
+        self.assertEqual(cache.size, 7)
+        self.assertFalse(cache.set("c", 3, 11))
+        self.assertNotIn("c", cache)
+        self.assertEqual(cache.pop("a"), 1)
+        self.assertEqual((len(cache), cache.size), (0, 0))
+
+    def test_json_dumps(self):
+        payload = {
+            "date": datetime.date(2022, 1, 31),
+            "datetime": datetime.datetime(2022, 1, 31, 10, 30),
+            "amount": Decimal("10.5"),
+            1: "int key",
+        }
+        expected = {
+            "date": "2022-01-31",
+            "datetime": "2022-01-31T10:30:00",
+            "amount": 10.5,
+            "1": "int key",
+        }
+        data = utils.json_dumps(payload)
+        self.assertIsInstance(data, bytes)
+        self.assertEqual(json.loads(data), expected)
+        with mock.patch.object(utils, "orjson", None):
+            data = utils.json_dumps(payload)
+        self.assertIsInstance(data, bytes)
+        self.assertEqual(json.loads(data), expected)
+        with self.assertRaises(TypeError):
+            utils.json_dumps({"record": object()})
+
+    def test_compress(self):
+        data = b'{"a": 1}' * 100
+        compressed = utils.compress(data, "gzip")
+        self.assertLess(len(compressed), len(data))
+        self.assertEqual(gzip.decompress(compressed), data)
+        chunks = utils.iter_compressed([data[:10], data[10:]], "gzip")
+        self.assertEqual(gzip.decompress(b"".join(chunks)), data)
+        if utils.brotli is not None:
+            compressed = utils.compress(data, "br")
+            self.assertEqual(utils.brotli.decompress(compressed), data)
+
+    def test_select_encoding(self):
+        def select(header):
+            accept = parse_accept_header(header)
+            return utils.select_encoding(accept)
+
+        self.assertIsNone(select(""))
+        self.assertIsNone(select("identity"))
+        self.assertEqual(select("gzip, deflate"), "gzip")
+        self.assertIsNone(select("gzip;q=0"))
+        self.assertEqual(select("*"), utils.supported_encodings()[0])
+        with mock.patch.object(utils, "brotli", None):
+            self.assertEqual(select("br, gzip"), "gzip")
+            self.assertIsNone(select("br"))
+
+    def _make_request_body(self, data, content_type="text/csv", chunk_size=2):
+        req = utils.EndpointRequest.build(
+            self.env,
+            "/demo/upload",
+            method="POST",
+            headers={"Content-Type": content_type},
+            data=data,
+        )
+        body = utils.RequestBody(req.httprequest)
+        body.chunk_size = chunk_size
+        return body
+
+    def test_request_body_chunks(self):
+        body = self._make_request_body(b"abcde")
+        self.assertEqual(list(body.iter_chunks()), [b"ab", b"cd", b"e"])
+        # Can be read again
+        self.assertEqual(b"".join(body.iter_chunks(chunk_size=10)), b"abcde")
+        # Body already read
+        body = self._make_request_body(b"abcde")
+        body.httprequest.get_data()
+        self.assertEqual(b"".join(body.iter_chunks()), b"abcde")
+
+    def test_request_body_lines(self):
+        body = self._make_request_body("a,é\r\nb,c\rd\ne".encode())
+        self.assertEqual(list(body.iter_lines()), ["a,é", "b,c", "d", "e"])
+        self.assertEqual(
+            list(body.iter_lines(keepends=True)), ["a,é\r\n", "b,c\r", "d\n", "e"]
+        )
+        body = self._make_request_body(
+            "a\nb".encode("latin-1"), content_type="text/csv; charset=latin-1"
+        )
+        self.assertEqual(list(body.iter_lines()), ["a", "b"])
+
+    def test_request_body_ndjson(self):
+        body = self._make_request_body(
+            b'{"a": 1}\n\n{"b": [1, 2]}\n', content_type="application/x-ndjson"
+        )
+        self.assertEqual(list(body.iter_ndjson()), [{"a": 1}, {"b": [1, 2]}])
+
+    def test_request_body_json_items(self):
+        data = b' [123, {"a": "x,]"}, null, true, 4.5e3, "s"] '
+        body = self._make_request_body(data, content_type="application/json")
+        expected = [123, {"a": "x,]"}, None, True, 4500.0, "s"]
+        self.assertEqual(list(body.iter_json_items()), expected)
+        for data in (b"[]", b" [ ] "):
+            body = self._make_request_body(data, content_type="application/json")
+            self.assertEqual(list(body.iter_json_items()), [])
+        for data in (b"{}", b"[1 2]", b"[1,", b"[1,]", b"[12", b""):
+            body = self._make_request_body(data, content_type="application/json")
+            with self.assertRaises(ValueError):
+                list(body.iter_json_items())
+
+    def test_endpoint_code_eval_request_body(self):
+        self.endpoint.code_snippet = textwrap.dedent(
+            """
+            total = sum(int(line.split(",")[1]) for line in request_body.iter_lines())
+            result = {"payload": total}
+            """
+        )
+        req = utils.EndpointRequest.build(
+            self.env,
+            "/demo/one",
+            method="POST",
+            headers={"Content-Type": "text/csv"},
+            data="a,1\nb,2\nc,3\n",
+        )
+        result = self.endpoint._handle_request(req)
+        self.assertEqual(result, {"payload": 6})
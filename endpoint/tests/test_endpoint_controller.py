@@ -2,13 +2,22 @@
 # @author: Simone Orsi <simone.orsi@camptocamp.com>
 # License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
 
+import base64
+import hashlib
+import hmac
 import json
 import os
+import textwrap
 import unittest
+from unittest import mock
+
+import psycopg2
 
 from odoo.tests.common import HttpCase
 from odoo.tools.misc import mute_logger
 
+from ..controllers import main as main_controller
+
 # odoo.addons.base.models.res_users: Login successful for db:openerp_test login:admin from n/a
 # endpoint.endpoint: Registered controller /demo/one/new (auth: user_endpoint)
 # odoo.addons.endpoint.models.ir_http: DROPPED /demo/one
@@ -70,6 +79,380 @@ class EndpointHttpCase(HttpCase):
         response = self.url_open("/demo/value_from_request?your_name=JonnyTest")
         self.assertEqual(response.content, b"JonnyTest")
 
+    def test_call_route_params(self):
+        self.env["endpoint.endpoint"].create(
+            {
+                "name": "Route params",
+                "route": "/demo/order/<int:order_id>/<string:name>",
+                "request_method": "GET",
+                "auth_type": "public",
+                "exec_as_user_id": self.env.ref("base.user_demo").id,
+                "exec_mode": "code",
+                "code_snippet": "result = {'payload': route_params}",
+            }
+        )
+        response = self.url_open("/demo/order/12/foo?order_id=1")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"order_id": 12, "name": "foo"})
+        response = self.url_open("/demo/order/foo/12")
+        self.assertEqual(response.status_code, 404)
+        # Metrics are labelled w/ the route, not w/ the path
+        data = {"requests": [{"route": "/demo/order/13/bar"}]}
+        response = self.url_open("/endpoint/batch", data=json.dumps(data))
+        self.assertEqual(response.json()[0]["body"], {"order_id": 13, "name": "bar"})
+        metrics = main_controller.EndpointMetrics.metrics_for(self.env.cr.dbname)
+        routes = {dict(labels).get("route") for __, labels in metrics._counters}
+        self.assertIn("/demo/order/<int:order_id>/<string:name>", routes)
+        self.assertNotIn("/demo/order/13/bar", routes)
+
+    def test_call_stateless(self):
+        self.env["endpoint.endpoint"].create(
+            {
+                "name": "Stateless",
+                "route": "/demo/stateless",
+                "request_method": "GET",
+                "auth_type": "public",
+                "stateless": True,
+                "exec_as_user_id": self.env.ref("base.user_demo").id,
+                "exec_mode": "code",
+                "code_snippet": "result = {'payload': 'ok'}",
+            }
+        )
+        response = self.url_open("/demo/stateless")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), "ok")
+        self.assertNotIn("Set-Cookie", response.headers)
+
+    def test_call_api_key(self):
+        user = self.env.ref("base.user_demo")
+        key = self.env["res.users.apikeys"].with_user(user)._generate(None, "Test")
+        self.env["endpoint.endpoint"].create(
+            {
+                "name": "API key",
+                "route": "/demo/api_key",
+                "request_method": "GET",
+                "auth_type": "api_key",
+                "exec_mode": "code",
+                "code_snippet": "result = {'payload': user.login}",
+            }
+        )
+        response = self.url_open("/demo/api_key")
+        self.assertEqual(response.status_code, 401)
+        response = self.url_open("/demo/api_key", headers={"API-KEY": "wrong"})
+        self.assertEqual(response.status_code, 401)
+        response = self.url_open("/demo/api_key", headers={"API-KEY": key})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), "demo")
+        response = self.url_open(
+            "/demo/api_key", headers={"Authorization": "Bearer " + key}
+        )
+        self.assertEqual(response.json(), "demo")
+        # Batch
+        data = {
+            "requests": [
+                {"route": "/demo/api_key"},
+                {"route": "/demo/api_key", "headers": {"API-KEY": key}},
+            ]
+        }
+        response = self.url_open("/endpoint/batch", data=json.dumps(data))
+        self.assertEqual([x["status"] for x in response.json()], [401, 200])
+        response = self.url_open(
+            "/endpoint/batch", data=json.dumps(data), headers={"API-KEY": key}
+        )
+        self.assertEqual([x["body"] for x in response.json()], ["demo", "demo"])
+
+    def test_job_status(self):
+        endpoint = self.env.ref("endpoint.endpoint_demo_1")
+        job = self.env["endpoint.job"].create(
+            {
+                "token": "secret-token",
+                "res_model": endpoint._name,
+                "res_id": endpoint.id,
+                "user_id": self.env.uid,
+            }
+        )
+        response = self.url_open("/endpoint/job/secret-token")
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(
+            response.json(),
+            {
+                "job": "secret-token",
+                "status": "pending",
+                "status_url": "/endpoint/job/secret-token",
+            },
+        )
+        job.write(
+            {
+                "state": "done",
+                "result_status": 201,
+                "result_content_type": "application/json",
+                "result_body": base64.b64encode(b'{"a": 1}'),
+            }
+        )
+        response = self.url_open("/endpoint/job/secret-token")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json(), {"a": 1})
+        response = self.url_open("/endpoint/job/wrong-token")
+        self.assertEqual(response.status_code, 404)
+
+    @mute_logger("endpoint.endpoint")
+    def test_batch(self):
+        data = {
+            "requests": [
+                {"route": "/demo/json_data"},
+                {"route": "/demo/value_from_request", "params": {"your_name": "Jo"}},
+                {"route": "/demo/one"},
+                {"route": "/demo/none"},
+                {"route": "/demo/raise_validation_error"},
+            ]
+        }
+        response = self.url_open("/endpoint/batch", data=json.dumps(data))
+        self.assertEqual(response.status_code, 200)
+        results = response.json()
+        self.assertEqual(
+            [x["status"] for x in results],
+            [200, 200, 401, 404, 400],
+        )
+        self.assertEqual(results[0]["body"], {"a": 1, "b": 2})
+        self.assertEqual(results[1]["body"], "Jo")
+
+    @mute_logger("endpoint.endpoint")
+    def test_batch_transaction(self):
+        data = {
+            "mode": "transaction",
+            "requests": [
+                {"route": "/demo/json_data"},
+                {"route": "/demo/raise_validation_error"},
+                {"route": "/demo/json_data"},
+            ],
+        }
+        response = self.url_open("/endpoint/batch", data=json.dumps(data))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([x["status"] for x in response.json()], [424, 400, 424])
+
+    def test_batch_session_csrf(self):
+        self.authenticate("admin", "admin")
+        data = {"requests": [{"route": "/demo/one"}]}
+        # The session cookie would be sent w/ cross-site requests too
+        response = self.url_open("/endpoint/batch", data=json.dumps(data))
+        self.assertEqual(response.status_code, 400)
+        secret = self.env["ir.config_parameter"].sudo().get_param("database.secret")
+        token = hmac.new(
+            secret.encode("ascii"), self.session.sid.encode(), hashlib.sha1
+        ).hexdigest()
+        response = self.url_open(
+            "/endpoint/batch",
+            data=json.dumps(data),
+            headers={"X-CSRF-Token": token + "o"},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([x["body"] for x in response.json()], ["ok"])
+
+    def test_batch_concurrency_error(self):
+        controller = main_controller.EndpointController()
+        with mock.patch.object(
+            type(controller),
+            "_handle_endpoint_request",
+            side_effect=psycopg2.extensions.TransactionRollbackError(),
+        ):
+            # Not reported as a failed sub-request: Odoo must retry the batch
+            with self.assertRaises(psycopg2.extensions.TransactionRollbackError):
+                controller._handle_batch(self.env, [{"route": "/demo/json_data"}])
+
+    def test_batch_bad_request(self):
+        response = self.url_open("/endpoint/batch", data="nope")
+        self.assertEqual(response.status_code, 400)
+        data = {"requests": [{"route": "/demo/json_data"}] * 51}
+        response = self.url_open("/endpoint/batch", data=json.dumps(data))
+        self.assertEqual(response.status_code, 400)
+        data = {"mode": "wrong", "requests": []}
+        response = self.url_open("/endpoint/batch", data=json.dumps(data))
+        self.assertEqual(response.status_code, 400)
+
     def test_call7(self):
         response = self.url_open("/demo/bad_method", data="ok")
         self.assertEqual(response.status_code, 405)
+
+    def test_call_compressed(self):
+        endpoint = self.env.ref("endpoint.endpoint_demo_3")
+        endpoint.compress_min_size = 1
+        response = self.url_open("/demo/json_data", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", response.headers["Vary"])
+        self.assertEqual(response.json(), {"a": 1, "b": 2})
+        response = self.url_open(
+            "/demo/json_data", headers={"Accept-Encoding": "identity"}
+        )
+        self.assertNotIn("Content-Encoding", response.headers)
+        self.assertEqual(response.json(), {"a": 1, "b": 2})
+        # Below the threshold
+        endpoint.compress_min_size = 1000
+        response = self.url_open("/demo/json_data", headers={"Accept-Encoding": "gzip"})
+        self.assertNotIn("Content-Encoding", response.headers)
+
+    def test_call_compressed_cached(self):
+        endpoint = self.env.ref("endpoint.endpoint_demo_3")
+        endpoint.write({"compress_min_size": 1, "cache_ttl": 60})
+        headers = {"Accept-Encoding": "gzip"}
+        response = self.url_open("/demo/json_data", headers=headers)
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        etag = response.headers["ETag"]
+        self.assertTrue(etag.endswith('-gzip"'))
+        with mock.patch.object(
+            main_controller.utils, "compress", side_effect=AssertionError
+        ):
+            # Compressed once
+            response = self.url_open("/demo/json_data", headers=headers)
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertEqual(response.json(), {"a": 1, "b": 2})
+        response = self.url_open(
+            "/demo/json_data", headers=dict(headers, **{"If-None-Match": etag})
+        )
+        self.assertEqual(response.status_code, 304)
+        response = self.url_open(
+            "/demo/json_data", headers={"Accept-Encoding": "identity"}
+        )
+        self.assertNotIn("Content-Encoding", response.headers)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+    def test_call_stream_compressed(self):
+        vals = {
+            "name": "Stream",
+            "route": "/demo/stream_gzip",
+            "request_method": "GET",
+            "exec_mode": "code",
+            "auth_type": "public",
+            "compress_min_size": 1,
+            "exec_as_user_id": self.env.ref("base.user_demo").id,
+            "code_snippet": "result = {'payload_iter': ({'i': i} for i in range(3))}",
+        }
+        self.env["endpoint.endpoint"].create(vals)
+        response = self.url_open(
+            "/demo/stream_gzip", headers={"Accept-Encoding": "gzip"}
+        )
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertEqual(response.json(), [{"i": 0}, {"i": 1}, {"i": 2}])
+
+    def test_call_cached(self):
+        endpoint = self.env.ref("endpoint.endpoint_demo_3")
+        endpoint.cache_ttl = 60
+        response = self.url_open("/demo/json_data")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("max-age=60", response.headers["Cache-Control"])
+        etag = response.headers["ETag"]
+        # Change the snippet w/o the ORM: the cached response is still served
+        self.env.cr.execute(
+            "UPDATE endpoint_endpoint SET code_snippet = %s WHERE id = %s",
+            ("result = {'payload': 'changed'}", endpoint.id),
+        )
+        endpoint.invalidate_cache()
+        response = self.url_open("/demo/json_data")
+        self.assertEqual(json.loads(response.content.decode()), {"a": 1, "b": 2})
+        response = self.url_open("/demo/json_data", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        # Writing on the endpoint invalidates the cache
+        endpoint.code_snippet = "result = {'payload': 'changed'}"
+        response = self.url_open("/demo/json_data")
+        self.assertEqual(json.loads(response.content.decode()), "changed")
+
+    def test_call_cached_size(self):
+        endpoint = self.env.ref("endpoint.endpoint_demo_3")
+        endpoint.write(
+            {
+                "cache_ttl": 60,
+                "compress_min_size": 1,
+                "code_snippet": "result = {'payload': 'x' * 1000}",
+            }
+        )
+        cache = main_controller.utils.SizedLRU(2000)
+        with mock.patch.object(main_controller, "_RESPONSE_CACHE", cache):
+            response = self.url_open(
+                "/demo/json_data", headers={"Accept-Encoding": "gzip"}
+            )
+            self.assertEqual(response.headers["Content-Encoding"], "gzip")
+            self.assertEqual(len(cache), 1)
+            # The compressed body is accounted as well
+            self.assertGreater(cache.size, 1002)
+            # Bodies bigger than the cache are not cached
+            endpoint.code_snippet = "result = {'payload': 'x' * 3000}"
+            response = self.url_open("/demo/json_data")
+            self.assertEqual(len(response.json()), 3000)
+            self.assertEqual(len(cache), 0)
+            self.assertEqual(cache.size, 0)
+
+    def test_call_stream(self):
+        vals = {
+            "name": "Stream",
+            "route": "/demo/stream",
+            "request_method": "GET",
+            "exec_mode": "code",
+            "auth_type": "public",
+            "exec_as_user_id": self.env.ref("base.user_demo").id,
+            "code_snippet": "result = {'payload_iter': ({'i': i} for i in range(3))}",
+        }
+        self.env["endpoint.endpoint"].create(vals)
+        response = self.url_open("/demo/stream")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["Content-Type"], "application/json")
+        data = json.loads(response.content.decode())
+        self.assertEqual(data, [{"i": 0}, {"i": 1}, {"i": 2}])
+
+    def test_call_stream_ndjson(self):
+        vals = {
+            "name": "Stream",
+            "route": "/demo/stream_ndjson",
+            "request_method": "GET",
+            "exec_mode": "code",
+            "auth_type": "public",
+            "exec_as_user_id": self.env.ref("base.user_demo").id,
+            "code_snippet": textwrap.dedent(
+                """
+                result = {
+                    "payload_iter": ({"i": i} for i in range(3)),
+                    "payload_format": "ndjson",
+                }
+                """
+            ),
+        }
+        self.env["endpoint.endpoint"].create(vals)
+        response = self.url_open("/demo/stream_ndjson")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["Content-Type"], "application/x-ndjson")
+        lines = response.content.decode().splitlines()
+        self.assertEqual([json.loads(x) for x in lines], [{"i": 0}, {"i": 1}, {"i": 2}])
+
+    def test_metrics(self):
+        response = self.url_open("/endpoint/metrics")
+        self.assertEqual(response.status_code, 403)
+        self.authenticate("admin", "admin")
+        self.url_open("/demo/one")
+        self.url_open("/demo/one")
+        response = self.url_open("/endpoint/metrics")
+        self.assertEqual(response.status_code, 200)
+        lines = response.content.decode().splitlines()
+        counter = [
+            x
+            for x in lines
+            if x.startswith(
+                'endpoint_requests_total{route="/demo/one",method="GET",status="200"}'
+            )
+        ]
+        self.assertTrue(counter)
+        self.assertGreaterEqual(float(counter[0].split()[-1]), 2)
+        self.assertIn(
+            'endpoint_request_duration_seconds_count{route="/demo/one",phase="handle"}',
+            response.content.decode(),
+        )
+
+    def test_metrics_token(self):
+        self.env["ir.config_parameter"].sudo().set_param(
+            "endpoint.metrics_token", "secret"
+        )
+        response = self.url_open(
+            "/endpoint/metrics", headers={"Authorization": "Bearer wrong"}
+        )
+        self.assertEqual(response.status_code, 403)
+        response = self.url_open(
+            "/endpoint/metrics", headers={"Authorization": "Bearer secret"}
+        )
+        self.assertEqual(response.status_code, 200)
@@ -0,0 +1,393 @@
+# Copyright 2021 Camptocamp SA
+# @author: Simone Orsi <simone.orsi@camptocamp.com>
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
+
+import codecs
+import datetime
+import json
+import logging
+import re
+import tempfile
+import threading
+import zlib
+from collections import OrderedDict
+from decimal import Decimal
+
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+
+from odoo.http import Response
+
+_logger = logging.getLogger(__name__)
+
+try:
+    import orjson
+except ImportError:
+    _logger.debug("`orjson` not installed: fallback to stdlib `json`")
+    orjson = None
+
+try:
+    import jsonschema
+except ImportError:
+    _logger.debug("`jsonschema` not installed: request schemas are not available")
+    jsonschema = None
+
+try:
+    import brotli
+except ImportError:
+    _logger.debug("`brotli` not installed: responses are compressed w/ gzip only")
+    brotli = None
+
+# Request bodies bigger than this are spilled to disk
+BODY_SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+_LINE_END_RE = re.compile(r"\r\n|\r|\n")
+_JSON_WHITESPACE_RE = re.compile(r"[ \t\n\r]*")
+
+# Compression levels favouring speed as responses are compressed on the fly
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def json_default(value):
+    """Convert values not natively supported by JSON encoders."""
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(
+        "Object of type {} is not JSON serializable".format(type(value).__name__)
+    )
+
+
+def json_dumps(value):
+    """Serialize given value to JSON.
+
+    Use `orjson` when available, stdlib `json` otherwise.
+    Dates and datetimes are converted to ISO 8601 strings, decimals to float.
+
+    :return: bytes
+    """
+    if orjson is not None:
+        return orjson.dumps(value, default=json_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(value, default=json_default).encode()
+
+
+def make_json_validator(schema):
+    """Return a validator for given JSON schema.
+
+    The validator class is picked according to the `$schema` of the schema,
+    the latest draft supported by `jsonschema` is used by default.
+
+    :raise: `jsonschema.SchemaError` if the schema is not valid
+    """
+    validator_cls = jsonschema.validators.validator_for(schema)
+    validator_cls.check_schema(schema)
+    return validator_cls(schema, format_checker=jsonschema.FormatChecker())
+
+
+def json_validation_error(validator, data):
+    """Return the most relevant validation error for given data, if any."""
+    return jsonschema.exceptions.best_match(validator.iter_errors(data))
+
+
+def supported_encodings():
+    """Return the content encodings available, preferred first."""
+    return ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def select_encoding(accept_encodings):
+    """Return the preferred encoding accepted by the client, if any.
+
+    :param accept_encodings: `Accept` object of the `Accept-Encoding` header
+    """
+    selected = None
+    best_quality = 0
+    for encoding in supported_encodings():
+        quality = accept_encodings.quality(encoding)
+        if quality > best_quality:
+            selected = encoding
+            best_quality = quality
+    return selected
+
+
+def iter_compressed(chunks, encoding):
+    """Compress given chunks of bytes w/ `gzip` or `br` encoding."""
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        compress, finish = compressor.process, compressor.finish
+    else:
+        # wbits = 16 + MAX_WBITS: gzip header and trailer
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compress, finish = compressor.compress, compressor.flush
+    for chunk in chunks:
+        data = compress(chunk)
+        if data:
+            yield data
+    yield finish()
+
+
+def compress(data, encoding):
+    """Compress given bytes w/ `gzip` or `br` encoding."""
+    return b"".join(iter_compressed([data], encoding))
+
+
+class SizedLRU:
+    """LRU mapping bounded by the total size of its values.
+
+    Sizes are given by the callers (eg: length of response bodies).
+    Least recently used entries are evicted once `max_size` is exceeded.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, size):
+        """Store given value and return True, unless it's bigger than the cache."""
+        with self._lock:
+            self._pop(key)
+            if size > self.max_size:
+                return False
+            self._entries[key] = [value, size]
+            self.size += size
+            self._evict()
+            return True
+
+    def grow(self, key, size):
+        """Account for `size` more bytes in the value of given key, if any."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry[1] += size
+            self.size += size
+            self._evict()
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._pop(key)
+            return default if entry is None else entry[0]
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries)
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+        return entry
+
+    def _evict(self):
+        while self.size > self.max_size:
+            __, (__, size) = self._entries.popitem(last=False)
+            self.size -= size
+
+
+class EndpointRequest:
+    """Request used to call endpoints outside of their HTTP request.
+
+    Provide the attributes of `odoo.http.request` used by endpoints.
+    """
+
+    def __init__(self, env, httprequest, params=None):
+        self.env = env
+        self.httprequest = httprequest
+        self.params = httprequest.values.to_dict() if params is None else params
+
+    @classmethod
+    def build(cls, env, path, method="GET", query_string=None, headers=None, data=None):
+        """Build a request from its parts.
+
+        :param data: body of the request as bytes or string
+        """
+        builder = EnvironBuilder(
+            path=path,
+            method=method,
+            query_string=query_string,
+            headers=headers,
+            data=data,
+        )
+        try:
+            # Same request class as Odoo (the default one lacks most attributes)
+            return cls(env, builder.get_request(Request))
+        finally:
+            builder.close()
+
+    @property
+    def uid(self):
+        return self.env.uid
+
+    @property
+    def context(self):
+        return self.env.context
+
+    @property
+    def cr(self):
+        return self.env.cr
+
+    def make_response(self, data, headers=None, cookies=None):
+        response = Response(data, headers=headers)
+        for name, value in (cookies or {}).items():
+            response.set_cookie(name, value)
+        return response
+
+
+class RequestBody:
+    """Read the body of a request incrementally.
+
+    The body is copied once from the input stream into a temporary file
+    (kept in memory up to `BODY_SPOOL_MAX_SIZE` bytes),
+    then each method iterates over it w/o loading it all in memory.
+    The copy is dropped once the object is garbage collected
+    as generators (eg: `payload_iter`) might still read it.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, httprequest):
+        self.httprequest = httprequest
+        self._file = None
+
+    @property
+    def charset(self):
+        return self.httprequest.mimetype_params.get("charset") or "utf-8"
+
+    def _get_file(self):
+        if self._file is None:
+            spool = tempfile.SpooledTemporaryFile(max_size=BODY_SPOOL_MAX_SIZE)
+            data = getattr(self.httprequest, "_cached_data", None)
+            if data is not None:
+                # Body already read (eg: to validate it): the stream is exhausted
+                spool.write(data)
+            else:
+                stream = self.httprequest.stream
+                for chunk in iter(lambda: stream.read(self.chunk_size), b""):
+                    spool.write(chunk)
+            self._file = spool
+        self._file.seek(0)
+        return self._file
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def iter_chunks(self, chunk_size=None):
+        """Yield raw chunks of bytes."""
+        body = self._get_file()
+        yield from iter(lambda: body.read(chunk_size or self.chunk_size), b"")
+
+    def iter_text(self, encoding=None):
+        """Yield chunks of decoded text."""
+        decoder = codecs.getincrementaldecoder(encoding or self.charset)()
+        for chunk in self.iter_chunks():
+            text = decoder.decode(chunk)
+            if text:
+                yield text
+        text = decoder.decode(b"", final=True)
+        if text:
+            yield text
+
+    def iter_lines(self, encoding=None, keepends=False):
+        """Yield decoded lines (eg: of CSV files).
+
+        Lines end w/ `\\n`, `\\r\\n` or `\\r`.
+        Use `keepends=True` to parse CSV w/ line breaks in quoted values.
+        """
+        pending = ""
+        for text in self.iter_text(encoding=encoding):
+            pending += text
+            start = 0
+            for match in _LINE_END_RE.finditer(pending):
+                if match.end() == len(pending) and match.group() == "\r":
+                    # Might be followed by `\n` in the next chunk
+                    break
+                yield pending[start : match.end() if keepends else match.start()]
+                start = match.end()
+            pending = pending[start:]
+        if pending:
+            if pending.endswith("\r") and not keepends:
+                pending = pending[:-1]
+            yield pending
+
+    def iter_ndjson(self, encoding=None):
+        """Yield the values of a newline delimited JSON body."""
+        for line in self.iter_lines(encoding=encoding):
+            if line.strip():
+                yield json.loads(line)
+
+    def iter_json_items(self, encoding=None):
+        """Yield the items of a JSON array body one by one.
+
+        :raise: `ValueError` if the body is not a valid JSON array
+        """
+        decoder = json.JSONDecoder()
+        texts = self.iter_text(encoding=encoding)
+        buffer = ""
+        pos = 0
+        eof = False
+        # Next token: `[`, 1st item or `]`, item, `,` or `]`
+        state = "start"
+        while True:
+            pos = _JSON_WHITESPACE_RE.match(buffer, pos).end()
+            end = None
+            if pos < len(buffer):
+                if state == "start":
+                    if buffer[pos] != "[":
+                        raise ValueError("Expecting a JSON array")
+                    pos += 1
+                    state = "first_item"
+                    continue
+                if state == "separator" or (
+                    state == "first_item" and buffer[pos] == "]"
+                ):
+                    if buffer[pos] == "]":
+                        return
+                    if buffer[pos] != ",":
+                        raise ValueError("Expecting `,` or `]` between items")
+                    pos += 1
+                    state = "item"
+                    continue
+                try:
+                    item, end = decoder.raw_decode(buffer, pos)
+                except ValueError:
+                    if eof:
+                        raise
+                if end is not None and not eof:
+                    # Values not followed by a separator might be truncated
+                    # (eg: `12` of `123` or `4` of `4.5`)
+                    next_char = buffer[end : end + 1]
+                    if not next_char or next_char not in " \t\n\r,]":
+                        end = None
+                if end is not None:
+                    yield item
+                    pos = end
+                    state = "separator"
+                    continue
+            elif eof:
+                raise ValueError("Unexpected end of JSON array")
+            # Read more
+            text = next(texts, None)
+            if text is None:
+                eof = True
+            else:
+                buffer = buffer[pos:] + text
+                pos = 0
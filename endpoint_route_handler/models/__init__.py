@@ -1,2 +1,3 @@
 from . import endpoint_route_handler
 from . import ir_http
+from . import res_users_apikeys
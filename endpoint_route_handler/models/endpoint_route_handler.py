@@ -3,8 +3,15 @@
 # License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
 
 import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
 
-from odoo import _, api, exceptions, fields, http, models
+from psycopg2 import sql
+
+from odoo import _, api, exceptions, fields, http, models, sql_db
+from odoo.tools import config, str2bool
 
 # from odoo.addons.base_sparse_field.models.fields import Serialized
 from ..registry import EndpointRegistry
@@ -13,6 +20,9 @@ ENDPOINT_ROUTE_CONSUMER_MODELS = {
     # by db
 }
 
+# Rules pending registration in the current thread, see `_endpoint_rules_batch`
+_RULES_BATCH = threading.local()
+
 
 class EndpointRouteHandler(models.AbstractModel):
 
@@ -50,6 +60,18 @@ class EndpointRouteHandler(models.AbstractModel):
 
     csrf = fields.Boolean(default=False)
 
+    stateless = fields.Boolean(
+        help="Do not save the session nor send the session cookie. "
+        "Only allowed for public endpoints and endpoints using API keys.",
+    )
+    read_only = fields.Boolean(
+        help="Handle requests w/ a read-only cursor: writes are blocked "
+        "and nothing is committed.\n"
+        "The cursor is connected to the read replica set via "
+        "the `endpoint_read_only_db_uri` server option, if any, "
+        "or to the main DB.",
+    )
+
     _sql_constraints = [
         (
             "endpoint_route_unique",
@@ -68,17 +90,10 @@ class EndpointRouteHandler(models.AbstractModel):
         somewhere else, because route controllers are registered only once
         for the same path.
         """
-        # TODO: add tests registering a fake model.
-        # However, @simahawk tested manually and it works.
-        # TODO: shall we check for route existance in the registry instead?
-        all_models = self._get_endpoint_route_consumer_models()
-        routes = [x["route"] for x in self.read(["route"])]
-        clashing_models = []
-        for model in all_models:
-            if model != self._name and self.env[model].sudo().search_count(
-                [("route", "in", routes)]
-            ):
-                clashing_models.append(model)
+        routes = [x for x in self.mapped("route") if x]
+        if not routes:
+            return
+        clashing_models = sorted(self._find_clashing_route_models(routes))
         if clashing_models:
             raise exceptions.UserError(
                 _(
@@ -88,6 +103,49 @@ class EndpointRouteHandler(models.AbstractModel):
                 % {"routes": ", ".join(routes), "models": ", ".join(clashing_models)}
             )
 
+    def _find_clashing_route_models(self, routes):
+        """Return the names of the other models using given routes.
+
+        Routes are looked up in the registry 1st,
+        remaining ones are checked in the DB w/ a single query.
+        """
+        all_models = [
+            x for x in self._get_endpoint_route_consumer_models() if x != self._name
+        ]
+        if not all_models:
+            return set()
+        clashing_models = set()
+        to_check = []
+        registry = self._endpoint_registry
+        for route in routes:
+            rule = registry.get_rule_by_route(route)
+            model = registry.key_model(rule.key) if rule else None
+            if model in all_models:
+                clashing_models.add(model)
+            else:
+                to_check.append(route)
+        if to_check:
+            clashing_models.update(
+                self._find_clashing_route_models_db(all_models, to_check)
+            )
+        return clashing_models
+
+    def _find_clashing_route_models_db(self, all_models, routes):
+        queries = []
+        for model in all_models:
+            self.env[model].flush(["route", "active"])
+            queries.append(
+                sql.SQL(
+                    "SELECT {model} FROM {table} WHERE active AND route IN %(routes)s"
+                ).format(
+                    model=sql.Literal(model),
+                    table=sql.Identifier(self.env[model]._table),
+                )
+            )
+        query = sql.SQL(" UNION ").join(queries)
+        self.env.cr.execute(query, {"routes": tuple(routes)})
+        return {x[0] for x in self.env.cr.fetchall()}
+
     def _get_endpoint_route_consumer_models(self):
         global ENDPOINT_ROUTE_CONSUMER_MODELS
         if ENDPOINT_ROUTE_CONSUMER_MODELS.get(self.env.cr.dbname):
@@ -112,7 +170,11 @@ class EndpointRouteHandler(models.AbstractModel):
         return [("http", "HTTP"), ("json", "JSON")]
 
     def _selection_auth_type(self):
-        return [("public", "Public"), ("user_endpoint", "User")]
+        return [
+            ("public", "Public"),
+            ("user_endpoint", "User"),
+            ("api_key", "API key"),
+        ]
 
     def _selection_request_method(self):
         return [
@@ -136,16 +198,21 @@ class EndpointRouteHandler(models.AbstractModel):
     def _compute_endpoint_hash(self):
         # Do not use read to be able to play this on NewId records too
         # (NewId records are classified as missing in ACL check).
-        # values = self.read(self._controller_fields())
-        values = [
-            {fname: rec[fname] for fname in self._controller_fields()} for rec in self
-        ]
-        for rec, vals in zip(self, values):
-            vals.pop("id", None)
-            rec.endpoint_hash = hash(tuple(vals.values()))
+        # Records support item access, hence they can be used as values.
+        for rec in self:
+            rec.endpoint_hash = rec._make_endpoint_hash(rec)
+
+    def _make_endpoint_hash(self, values):
+        """Compute the hash identifying a route from its field values.
+
+        :param values: record or dict of values by field name
+        """
+        return hash(
+            tuple(values[fname] for fname in self._controller_fields() if fname != "id")
+        )
 
     def _controller_fields(self):
-        return ["route", "auth_type", "request_method"]
+        return ["route", "auth_type", "request_method", "stateless"]
 
     @api.depends("route")
     def _compute_route(self):
@@ -179,6 +246,19 @@ class EndpointRouteHandler(models.AbstractModel):
                     _("`%s` uses a blacklisted routed = `%s`") % (rec.name, rec.route)
                 )
 
+    @api.constrains("stateless", "auth_type")
+    def _check_stateless(self):
+        for rec in self:
+            if rec.stateless and rec.auth_type not in rec._stateless_auth_types():
+                raise exceptions.UserError(
+                    _("`%s`: stateless mode is not allowed for auth type `%s`")
+                    % (rec.name, rec.auth_type)
+                )
+
+    def _stateless_auth_types(self):
+        """Return the auth types not relying on the session."""
+        return ("public", "api_key")
+
     @api.constrains("request_method", "request_content_type")
     def _check_request_method(self):
         for rec in self:
@@ -187,6 +267,45 @@ class EndpointRouteHandler(models.AbstractModel):
                     _("Request method is required for POST and PUT.")
                 )
 
+    # Read-only cursor
+
+    @contextmanager
+    def _endpoint_read_only_env(self):
+        """Yield an environment w/ a read-only cursor.
+
+        The cursor is connected to the DB set via the `endpoint_read_only_db_uri`
+        server option (eg: `postgresql://user@replica:5432/db`)
+        or to the current DB otherwise.
+        Its transaction is never committed.
+
+        The environment has its own cache: values read through it never
+        leak into the caller's cache, which is left untouched.
+        Records are read from the read-only cursor, hence changes
+        not committed yet are not visible.
+        """
+        # Pending writes must not go through the read-only cursor
+        self.env["base"].flush()
+        dbname = self.env.cr.dbname
+        uri = config.get("endpoint_read_only_db_uri")
+        cr = sql_db.db_connect(uri or dbname, allow_uri=bool(uri)).cursor()
+        # The replica is a copy of the current DB: share its registry
+        cr.dbname = dbname
+        # Same as `api.Environment.manage()`, which is a no-op when nested:
+        # envs derived from `env` (eg: `with_user`) share this cache as well.
+        local = api.Environment._local
+        environments = local.environments
+        local.environments = api.Environments()
+        try:
+            env = api.Environment(cr, self.env.uid, self.env.context, su=self.env.su)
+            cr.execute("SET TRANSACTION READ ONLY")
+            yield env
+            # Make writes fail instead of dropping them silently
+            env["base"].flush()
+        finally:
+            # Values read from the replica and writes not flushed go away
+            local.environments = environments
+            cr.close()
+
     # Handle automatic route registration
 
     @api.model_create_multi
@@ -218,25 +337,152 @@ class EndpointRouteHandler(models.AbstractModel):
             self._unregister_controllers()
         return super().unlink()
 
+    def init(self):
+        super().init()
+        EndpointRegistry._setup_db(self.env.cr)
+
     def _register_hook(self):
         super()._register_hook()
         if not self._abstract:
-            # Look explicitly for active records.
-            # Pass `init` to not set the registry as updated
-            # since this piece of code runs only when the model is loaded.
-            self.search([("active", "=", True)])._register_controllers(init=True)
+            # Changes done by other workers while loading must be pulled later.
+            self._endpoint_registry.init_version(self.env.cr)
+            start = time.perf_counter()
+            if self._endpoint_route_lazy_load():
+                mode = "lazy"
+                count = self._register_controllers_lazy()
+            else:
+                mode = "eager"
+                # Look explicitly for active records.
+                # Pass `init` to not set the registry as updated
+                # since this piece of code runs only when the model is loaded.
+                records = self.search([("active", "=", True)])
+                records._register_controllers(init=True)
+                count = len(records)
+            self._logger.info(
+                "Loaded %d endpoint rules in %.3fs (%s)",
+                count,
+                time.perf_counter() - start,
+                mode,
+            )
+
+    def _endpoint_route_lazy_load(self):
+        """Tell if rules must be loaded lazily at startup.
+
+        Enabled via the `endpoint_route_lazy_load` server option.
+        Lazy loading requires all the routing fields to be stored
+        and the hooks building rules not to be overridden
+        as rules are built straight from the values of the fields.
+        """
+        if not str2bool(config.get("endpoint_route_lazy_load") or "0", False):
+            return False
+        fnames = self._endpoint_routing_fields() + ["active"]
+        not_stored = [x for x in fnames if not self._fields[x].store]
+        if not_stored:
+            self._logger.warning(
+                "Cannot load rules lazily, fields not stored: %s", ", ".join(not_stored)
+            )
+            return False
+        overridden = [
+            x
+            for x in self._endpoint_rule_hooks()
+            if getattr(type(self), x) is not getattr(EndpointRouteHandler, x)
+        ]
+        if overridden:
+            self._logger.warning(
+                "Cannot load rules lazily, hooks overridden: %s", ", ".join(overridden)
+            )
+            return False
+        return True
+
+    def _endpoint_rule_hooks(self):
+        """Return the per-record hooks building rules, bypassed by lazy loading."""
+        return ["_register_controller", "_make_controller_rule", "_get_routing_info"]
+
+    def _endpoint_routing_fields(self):
+        """Return the fields needed to build routing rules."""
+        fnames = ["route", "route_group", "route_type", "auth_type", "csrf"]
+        fnames += ["request_method"] + self._controller_fields()
+        return list(dict.fromkeys(x for x in fnames if x != "id"))
+
+    def _register_controllers_lazy(self):
+        """Register rules of active records w/o loading them via the ORM.
+
+        Routing values are read straight from the table
+        and endpoint handlers are resolved on their 1st call.
+
+        :return: number of rules registered
+        """
+        fnames = self._endpoint_routing_fields()
+        query = sql.SQL("SELECT id, {fields} FROM {table} WHERE active").format(
+            fields=sql.SQL(", ").join(map(sql.Identifier, fnames)),
+            table=sql.Identifier(self._table),
+        )
+        self.env.cr.execute(query)
+        registry = self._endpoint_registry
+        rules = []
+        for row in self.env.cr.dictfetchall():
+            # Mimic the ORM which returns False for empty values
+            values = {x: False if row[x] is None else row[x] for x in fnames}
+            route, routing = self._make_routing_info(values)
+            handler = LazyEndpointHandler(self._name, row["id"])
+            rules.append(
+                registry.make_rule(
+                    # fmt: off
+                    self.browse(row["id"])._endpoint_registry_unique_key(),
+                    route,
+                    http.EndPoint(handler, routing),
+                    routing,
+                    # Same as computed field value
+                    str(self._make_endpoint_hash(values)),
+                    route_group=values["route_group"]
+                    # fmt: on
+                )
+            )
+        registry.add_or_update_rules(rules, init=True)
+        return len(rules)
 
     def _register_controllers(self, init=False):
         if self._abstract:
             self._refresh_endpoint_data()
-        for rec in self:
-            rec._register_controller(init=init)
+        # Go through the per-record hook but register all the rules at once
+        # to update routing maps only once.
+        with self._endpoint_rules_batch(init=init):
+            for rec in self:
+                rec._register_controller(init=init)
+
+    @contextmanager
+    def _endpoint_rules_batch(self, init=False):
+        """Collect rules registered in this block and register them on exit."""
+        if getattr(_RULES_BATCH, "rules", None) is not None:
+            # Nested batch: the outermost one registers the rules
+            yield
+            return
+        _RULES_BATCH.rules = rules = []
+        try:
+            yield
+        finally:
+            _RULES_BATCH.rules = None
+        keys = self._endpoint_register_rules(rules, init=init)
+        self._logger.debug("Registered %d controllers", len(keys))
+
+    def _endpoint_register_rules(self, rules, init=False):
+        pending = getattr(_RULES_BATCH, "rules", None)
+        if pending is not None:
+            pending.extend(rules)
+            return []
+        keys = self._endpoint_registry.add_or_update_rules(rules, init=init)
+        if keys and not init:
+            self._endpoint_registry_notify_changes(keys)
+        return keys
 
     def _unregister_controllers(self):
         if self._abstract:
             self._refresh_endpoint_data()
-        for rec in self:
-            rec._unregister_controller()
+        keys = self._endpoint_registry.drop_rules(
+            [rec._endpoint_registry_unique_key() for rec in self]
+        )
+        if keys:
+            self._endpoint_registry_notify_changes(keys)
 
     def _refresh_endpoint_data(self):
         """Enforce refresh of route computed fields.
@@ -252,7 +498,7 @@ class EndpointRouteHandler(models.AbstractModel):
 
     def _register_controller(self, endpoint_handler=None, key=None, init=False):
         rule = self._make_controller_rule(endpoint_handler=endpoint_handler, key=key)
-        self._endpoint_registry.add_or_update_rule(rule, init=init)
+        self._endpoint_register_rules([rule], init=init)
         self._logger.debug(
             "Registered controller %s (auth: %s)", self.route, self.auth_type
         )
@@ -283,19 +529,104 @@ class EndpointRouteHandler(models.AbstractModel):
         raise NotImplementedError("No default endpoint handler defined.")
 
     def _get_routing_info(self):
-        route = self.route
+        route, routing = self._make_routing_info(self)
+        return route, routing, self.endpoint_hash
+
+    def _make_routing_info(self, values):
+        """Build routing info from field values.
+
+        :param values: record or dict of values by field name
+        """
+        route = values["route"]
         routing = dict(
-            type=self.route_type,
-            auth=self.auth_type,
-            methods=[self.request_method],
+            type=values["route_type"],
+            auth=values["auth_type"],
+            methods=[values["request_method"]],
             routes=[route],
-            csrf=self.csrf,
+            csrf=values["csrf"],
         )
-        return route, routing, self.endpoint_hash
+        if values["stateless"]:
+            # The session is still loaded by Odoo but never saved
+            routing["save_session"] = False
+        return route, routing
 
     def _endpoint_registry_unique_key(self):
         return "{0._name}:{0.id}".format(self)
 
+    @api.model
+    def _endpoint_registry_parse_key(self, key):
+        """Return model name and record id matching given registry key.
+
+        :return: tuple `(model, id)` or `(None, None)` for custom keys
+        """
+        model, __, res_id = key.rpartition(":")
+        if model in self.env and res_id.isdigit():
+            return model, int(res_id)
+        return None, None
+
     def _unregister_controller(self, key=None):
         key = key or self._endpoint_registry_unique_key()
-        self._endpoint_registry.drop_rule(key)
+        if self._endpoint_registry.drop_rule(key):
+            self._endpoint_registry_notify_changes([key])
+
+    def _endpoint_registry_notify_changes(self, keys):
+        """Let other workers know that rules matching `keys` changed."""
+        if self.env.context.get("endpoint_route_sync"):
+            # Changes are coming from other workers already
+            return
+        self._endpoint_registry.notify_changes(self.env.cr, keys)
+
+    @api.model
+    def _endpoint_registry_sync(self):
+        """Reload rules changed by other workers.
+
+        Only rules whose key is in the form `model:id`
+        (see `_endpoint_registry_unique_key`) can be reloaded.
+        Models using custom keys must take care of their own rules.
+        """
+        keys = self._endpoint_registry.pull_changes(self.env.cr)
+        ids_by_model = defaultdict(list)
+        for key in keys:
+            model, res_id = self._endpoint_registry_parse_key(key)
+            if model:
+                ids_by_model[model].append(res_id)
+            else:
+                self._logger.debug("Cannot sync endpoint rule `%s`", key)
+        for model, ids in ids_by_model.items():
+            self.env[model].sudo().with_context(
+                endpoint_route_sync=True
+            )._endpoint_registry_sync_records(ids)
+        return keys
+
+    @api.model
+    def _endpoint_registry_sync_records(self, ids):
+        records = self.browse(ids).exists()
+        if "active" in records._fields:
+            records = records.filtered("active")
+        records._register_controllers()
+        self.browse(list(set(ids) - set(records.ids)))._unregister_controllers()
+
+
+class LazyEndpointHandler:
+    """Endpoint handler resolved on its 1st call.
+
+    Used for rules loaded lazily at startup:
+    the handler is provided by `_default_endpoint_handler`
+    of the record matching the rule.
+    """
+
+    __slots__ = ("model", "res_id", "_handler")
+
+    def __init__(self, model, res_id):
+        self.model = model
+        self.res_id = res_id
+        self._handler = None
+
+    def resolve(self, env):
+        if self._handler is None:
+            record = env[self.model].sudo().browse(self.res_id)
+            self._handler = record._default_endpoint_handler()
+        return self._handler
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve(http.request.env)(*args, **kwargs)
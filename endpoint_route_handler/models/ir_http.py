@@ -3,6 +3,7 @@
 # License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
 
 import logging
+from functools import partial
 from itertools import chain
 
 import werkzeug
@@ -31,10 +32,70 @@ class IrHttp(models.AbstractModel):
         cr = http.request.env.cr
         e_registry = EndpointRegistry.registry_for(cr.dbname)
         for endpoint_rule in e_registry.get_rules():
+            if endpoint_rule.dispatched:
+                # Handled by the catch-all rule of its prefix
+                continue
             _logger.debug("LOADING %s", endpoint_rule)
-            endpoint = endpoint_rule.endpoint
-            for url in endpoint_rule.routing["routes"]:
-                yield (url, endpoint, endpoint_rule.routing)
+            yield from cls._endpoint_rule_routes(endpoint_rule)
+        for prefix in e_registry.dispatch_prefixes:
+            _logger.debug("LOADING catch-all rule for %s", prefix)
+            yield cls._endpoint_dispatch_route(prefix)
+
+    @classmethod
+    def _endpoint_dispatch_route(cls, prefix):
+        """Return the catch-all route dispatching requests for given prefix.
+
+        Authentication and CSRF check are done by the dispatcher
+        according to the matching rule.
+        Arguments prefixed w/ `_ignored_` are not passed to the endpoint.
+        """
+        url = prefix + "/<path:_ignored_endpoint_path>"
+        routing = dict(type="http", auth="none", methods=None, routes=[url], csrf=False)
+        return (url, http.EndPoint(cls._endpoint_dispatch, routing), routing)
+
+    @classmethod
+    def _endpoint_dispatch(cls, **params):
+        """Dispatch the current request to the matching endpoint rule."""
+        request = http.request
+        e_registry = EndpointRegistry.registry_for(request.env.cr.dbname)
+        httprequest = request.httprequest
+        endpoint_rule, arguments = e_registry.match(
+            httprequest.path, method=httprequest.method, dispatched_only=True
+        )
+        if endpoint_rule is None:
+            raise werkzeug.exceptions.NotFound()
+        endpoint = endpoint_rule.endpoint
+        auth_method = cls._authenticate(endpoint)
+        cls._endpoint_dispatch_check_csrf(endpoint, params)
+        # Bind arguments to make sure they are passed again
+        # if the call is retried (eg: on serialization failures).
+        request.set_handler(
+            http.EndPoint(partial(endpoint, **arguments), endpoint.routing),
+            arguments,
+            auth_method,
+        )
+        return request.endpoint(**params)
+
+    @classmethod
+    def _endpoint_dispatch_check_csrf(cls, endpoint, params):
+        """Check CSRF token like `odoo.http.HttpRequest.dispatch` does."""
+        request = http.request
+        if request.httprequest.method in ("GET", "HEAD", "OPTIONS", "TRACE"):
+            return
+        if not endpoint.routing.get("csrf", True):
+            return
+        token = params.pop("csrf_token", None)
+        if not request.validate_csrf(token):
+            _logger.warning(
+                "CSRF validation failed on path '%s'", request.httprequest.path
+            )
+            raise werkzeug.exceptions.BadRequest("Session expired (invalid CSRF token)")
+
+    @classmethod
+    def _endpoint_rule_routes(cls, endpoint_rule):
+        endpoint = endpoint_rule.endpoint
+        for url in endpoint_rule.routing["routes"]:
+            yield (url, endpoint, endpoint_rule.routing)
 
     @classmethod
     def routing_map(cls, key=None):
@@ -51,6 +112,15 @@ class IrHttp(models.AbstractModel):
         # across envs... well, this is how it works today so we have to deal w/ it.
         http_id = cls._endpoint_make_http_id()
 
+        # Pull changes done by other workers, if any.
+        # Once per request: the routing map is used to build every URL
+        # of a page (eg: `url_for`), it must stay cheap.
+        request = http.request
+        # Not `getattr`: tests use a `Mock` as request (see `MockRequest`)
+        if not request.__dict__.get("_endpoint_registry_synced"):
+            request.env["endpoint.route.handler"]._endpoint_registry_sync()
+            request._endpoint_registry_synced = True
+
         is_routing_map_new = not hasattr(cls, "_routing_map")
         if is_routing_map_new or not e_registry.ir_http_seen(http_id):
             # When the routing map is not ready yet, simply track current instance
@@ -61,15 +131,69 @@ class IrHttp(models.AbstractModel):
         ):
             # This instance was already tracked
             # and meanwhile the registry got updated:
-            # ensure all routes are re-loaded.
+            # ensure changed routes are re-loaded.
             _logger.info(
-                "Endpoint registry updated, reset routing ma for `%s`", http_id
+                "Endpoint registry updated, patch routing map for `%s`", http_id
             )
-            cls._routing_map = {}
-            cls._rewrite_len = {}
-            e_registry.reset_update_required(http_id)
+            changes = e_registry.reset_update_required(http_id)
+            cls._endpoint_patch_routing_maps(e_registry, changes)
         return super().routing_map(key=key)
 
+    @classmethod
+    def _endpoint_patch_routing_maps(cls, e_registry, changes):
+        """Update existing routing maps w/ changed rules only.
+
+        Rebuilding the routing map from scratch means scanning
+        all the controllers of all installed modules,
+        hence we add and remove only the rules that changed.
+        """
+        for routing_map in cls._routing_map.values():
+            if not cls._endpoint_patch_routing_map(routing_map, e_registry, changes):
+                _logger.info("Cannot patch routing map: reset it")
+                cls._routing_map = {}
+                cls._rewrite_len = {}
+                return
+
+    @classmethod
+    def _endpoint_patch_routing_map(cls, routing_map, e_registry, changes):
+        if not hasattr(routing_map, "_rules_by_endpoint"):
+            # werkzeug internals changed
+            return False
+        to_remove = set()
+        to_add = []
+        for key, old_rule in changes.items():
+            if old_rule is not None:
+                for rule in routing_map._rules_by_endpoint.pop(old_rule.endpoint, []):
+                    # werkzeug rules are unhashable and compare on their path
+                    to_remove.add(id(rule))
+                _logger.debug("DROPPED %s", old_rule)
+            endpoint_rule = e_registry.get_rule(key)
+            if endpoint_rule is not None and not endpoint_rule.dispatched:
+                to_add.extend(cls._endpoint_make_werkzeug_rules(endpoint_rule))
+                _logger.debug("LOADED %s", endpoint_rule)
+        if to_remove:
+            routing_map._rules = [
+                x for x in routing_map._rules if id(x) not in to_remove
+            ]
+        for rule in to_add:
+            routing_map.add(rule)
+        routing_map._remap = True
+        return True
+
+    @classmethod
+    def _endpoint_make_werkzeug_rules(cls, endpoint_rule):
+        """Build werkzeug rules the same way `ir.http.routing_map` does."""
+        xtra_keys = (
+            "defaults subdomain build_only strict_slashes redirect_to alias host"
+        ).split()
+        for url, endpoint, routing in cls._endpoint_rule_routes(endpoint_rule):
+            kw = {k: routing[k] for k in xtra_keys if k in routing}
+            rule = werkzeug.routing.Rule(
+                url, endpoint=endpoint, methods=routing["methods"], **kw
+            )
+            rule.merge_slashes = False
+            yield rule
+
     @classmethod
     def _endpoint_make_http_id(cls):
         """Generate current ir.http class ID."""
@@ -92,3 +216,30 @@ class IrHttp(models.AbstractModel):
             cls._auth_method_user()
         except http.SessionExpiredException:
             raise werkzeug.exceptions.Unauthorized()
+
+    @classmethod
+    def _auth_method_api_key(cls):
+        """Authenticate the owner of the API key sent w/ the request.
+
+        See `_endpoint_get_api_key` and `res.users.apikeys`.
+        """
+        request = http.request
+        key = cls._endpoint_get_api_key(request.httprequest)
+        uid = None
+        if key:
+            apikeys = request.env["res.users.apikeys"].sudo()
+            uid = apikeys._endpoint_check_credentials(key)
+        if not uid:
+            raise werkzeug.exceptions.Unauthorized()
+        request.uid = uid
+
+    @classmethod
+    def _endpoint_get_api_key(cls, httprequest):
+        """Read the API key from `API-KEY` or `Authorization: Bearer` headers."""
+        key = httprequest.headers.get("API-KEY")
+        if not key:
+            auth = httprequest.headers.get("Authorization") or ""
+            scheme, __, token = auth.partition(" ")
+            if scheme.lower() == "bearer":
+                key = token.strip()
+        return key or None
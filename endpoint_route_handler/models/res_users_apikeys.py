@@ -0,0 +1,77 @@
+# Copyright 2021 Camptocamp SA
+# @author: Simone Orsi <simone.orsi@camptocamp.com>
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
+
+import hashlib
+import time
+
+from odoo import api, models
+from odoo.tools.lru import LRU
+
+from odoo.addons.base.models.res_users import INDEX_SIZE, KEY_CRYPT_CONTEXT
+
+# Verified API keys by (dbname, key digest): (apikey id, user id, expires at)
+_API_KEY_CACHE = LRU(1024)
+# Seconds a verified API key is kept in cache
+API_KEY_CACHE_TTL = 300
+
+
+class ResUsersApikeys(models.Model):
+    _inherit = "res.users.apikeys"
+
+    # Scope of the keys allowed to call endpoints, besides keys w/o scope
+    _endpoint_api_key_scope = "endpoint"
+
+    @api.model
+    def _endpoint_check_credentials(self, key):
+        """Return the ID of the user owning given API key.
+
+        Hashing keys is slow on purpose: once verified,
+        keys are cached by digest and only their existence is checked.
+
+        :return: user ID or None if the key is not valid
+        """
+        cache_key = (self.env.cr.dbname, hashlib.sha256(key.encode()).hexdigest())
+        cached = _API_KEY_CACHE.get(cache_key)
+        if cached is not None:
+            apikey_id, user_id, expires_at = cached
+            # The key might have been revoked by another worker
+            if expires_at > time.time() and self._endpoint_check_apikey_id(apikey_id):
+                return user_id
+            try:
+                del _API_KEY_CACHE[cache_key]
+            except KeyError:
+                # Dropped by another thread
+                pass
+        query = """
+            SELECT k.id, k.user_id, k.key
+            FROM {} k INNER JOIN res_users u ON (u.id = k.user_id)
+            WHERE u.active AND k.index = %s AND (k.scope IS NULL OR k.scope = %s)
+        """.format(
+            self._table
+        )
+        self.env.cr.execute(query, [key[:INDEX_SIZE], self._endpoint_api_key_scope])
+        for apikey_id, user_id, hashed_key in self.env.cr.fetchall():
+            if KEY_CRYPT_CONTEXT.verify(key, hashed_key):
+                expires_at = time.time() + API_KEY_CACHE_TTL
+                _API_KEY_CACHE[cache_key] = (apikey_id, user_id, expires_at)
+                return user_id
+        return None
+
+    @api.model
+    def _endpoint_check_apikey_id(self, apikey_id):
+        query = """
+            SELECT 1
+            FROM {} k INNER JOIN res_users u ON (u.id = k.user_id)
+            WHERE u.active AND k.id = %s
+        """.format(
+            self._table
+        )
+        self.env.cr.execute(query, [apikey_id])
+        return bool(self.env.cr.fetchone())
+
+    def unlink(self):
+        # Revoked keys must not be served from cache anymore.
+        # Keys are cached by digest: drop all of them, revoking is rare.
+        _API_KEY_CACHE.clear()
+        return super().unlink()
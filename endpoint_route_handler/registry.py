@@ -2,6 +2,19 @@
 # @author: Simone Orsi <simone.orsi@camptocamp.com>
 # License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
 
+import re
+
+from werkzeug.exceptions import MethodNotAllowed
+from werkzeug.routing import (
+    Map,
+    PathConverter,
+    ValidationError,
+    parse_converter_args,
+    parse_rule,
+)
+
+from odoo.tools import config
+
 _REGISTRY_BY_DB = {}
 
 
@@ -13,26 +26,86 @@ class EndpointRegistry:
     * track registered endpoints
     * track routes to be updated for specific ir.http instances
     * retrieve routing rules to load in ir.http routing map
+    * keep rules in sync across workers via a version tracked in the DB
+    * dispatch http rules under given prefixes w/o using the routing map
     """
 
-    __slots__ = ("_mapping", "_http_ids", "_http_ids_to_update")
+    __slots__ = (
+        "_mapping",
+        "_rules_by_route",
+        "_rules_by_group",
+        "_rules_by_model",
+        "_http_ids",
+        "_http_ids_to_update",
+        "_version",
+        "_trie",
+        "dispatch_prefixes",
+    )
 
-    def __init__(self):
+    def __init__(self, dispatch_prefixes=()):
         # collect EndpointRule objects
         self._mapping = {}
+        # index rule keys by route
+        self._rules_by_route = {}
+        # index rule keys by route group
+        self._rules_by_group = {}
+        # index rule keys by model (see `key_model`)
+        self._rules_by_model = {}
         # collect ids of ir.http instances
         self._http_ids = set()
-        # collect ids of ir.http instances that need update
-        self._http_ids_to_update = set()
+        # collect changes by ids of ir.http instances that need update
+        self._http_ids_to_update = {}
+        # last DB version known by this registry
+        self._version = None
+        # match paths against rule routes
+        self._trie = RouteTrie()
+        # http rules under these prefixes are dispatched by the registry
+        self.dispatch_prefixes = tuple(dispatch_prefixes)
 
     def get_rules(self):
         return self._mapping.values()
 
-    # TODO: add test
     def get_rules_by_group(self, group):
-        for key, rule in self._mapping.items():
-            if rule.route_group == group:
-                yield (key, rule)
+        for key in self._rules_by_group.get(group, ()):
+            yield (key, self._mapping[key])
+
+    def get_rules_by_model(self, model):
+        for key in self._rules_by_model.get(model, ()):
+            yield (key, self._mapping[key])
+
+    def get_rule(self, key):
+        return self._mapping.get(key)
+
+    def get_rule_by_route(self, route):
+        key = self._rules_by_route.get(route)
+        return self._mapping.get(key) if key else None
+
+    def match(self, path, method=None, dispatched_only=False):
+        """Find the rule matching given path.
+
+        :param path: path to match
+        :param method: HTTP method of the request
+        :param dispatched_only: consider only rules dispatched by the registry
+        :return: tuple `(rule, params)` or `(None, None)`
+        :raise: MethodNotAllowed if the path matches only w/ other methods
+        """
+        valid_methods = set()
+        for key, params in self._trie.match(path):
+            rule = self._mapping[key]
+            if dispatched_only and not rule.dispatched:
+                continue
+            methods = rule.routing.get("methods")
+            if (
+                not methods
+                or method is None
+                or method in methods
+                or (method == "HEAD" and "GET" in methods)
+            ):
+                return rule, params
+            valid_methods.update(methods)
+        if valid_methods:
+            raise MethodNotAllowed(valid_methods=sorted(valid_methods))
+        return None, None
 
     def add_or_update_rule(self, rule, force=False, init=False):
         """Add or update an existing rule.
@@ -41,43 +114,165 @@ class EndpointRegistry:
         :param force: replace a rule forcedly
         :param init: given when adding rules for the first time
         """
-        key = rule.key
-        existing = self._mapping.get(key)
-        if not existing or force:
-            self._mapping[key] = rule
-            if not init:
-                self._refresh_update_required()
-            return True
-        if existing.endpoint_hash != rule.endpoint_hash:
-            # Override and set as to be updated
-            self._mapping[key] = rule
-            if not init:
-                self._refresh_update_required()
-            return True
+        return bool(self.add_or_update_rules([rule], force=force, init=init))
+
+    def add_or_update_rules(self, rules, force=False, init=False):
+        """Add or update several rules at once.
+
+        Tracked ir.http instances are flagged for update only once.
+
+        :param rules: list of EndpointRule
+        :param force: replace rules forcedly
+        :param init: given when adding rules for the first time
+        :return: keys of the rules added or updated
+        """
+        changes = {}
+        for rule in rules:
+            key = rule.key
+            existing = self._mapping.get(key)
+            if not existing or force or existing.endpoint_hash != rule.endpoint_hash:
+                # Override and set as to be updated
+                self._set_rule(rule, existing)
+                changes.setdefault(key, existing)
+        if changes and not init:
+            self._refresh_update_required(changes)
+        return list(changes)
 
     def drop_rule(self, key):
-        existing = self._mapping.pop(key, None)
-        if not existing:
-            return False
-        self._refresh_update_required()
-        return True
+        return bool(self.drop_rules([key]))
+
+    def drop_rules(self, keys):
+        """Drop several rules at once.
+
+        :return: keys of the rules dropped
+        """
+        changes = {}
+        for key in keys:
+            existing = self._mapping.pop(key, None)
+            if existing:
+                self._unindex_rule(existing)
+                changes[key] = existing
+        if changes:
+            self._refresh_update_required(changes)
+        return list(changes)
+
+    def drop_rules_by_group(self, group):
+        """Drop all the rules of given route group.
+
+        :return: keys of the rules dropped
+        """
+        return self.drop_rules(list(self._rules_by_group.get(group, ())))
+
+    def drop_rules_by_model(self, model):
+        """Drop all the rules of given model.
+
+        :return: keys of the rules dropped
+        """
+        return self.drop_rules(list(self._rules_by_model.get(model, ())))
 
     def routing_update_required(self, http_id):
-        return http_id in self._http_ids_to_update
+        return bool(self._http_ids_to_update.get(http_id))
+
+    def _refresh_update_required(self, changes):
+        """Flag tracked ir.http instances for update.
 
-    def _refresh_update_required(self):
+        :param changes: dict `{key: old rule}`
+        """
+        # Rules dispatched by the registry are not in routing maps
+        changes = {
+            key: old_rule
+            for key, old_rule in changes.items()
+            if (old_rule and not old_rule.dispatched)
+            or (key in self._mapping and not self._mapping[key].dispatched)
+        }
+        if not changes:
+            return
         for http_id in self._http_ids:
-            self._http_ids_to_update.add(http_id)
+            pending = self._http_ids_to_update.setdefault(http_id, {})
+            for key, old_rule in changes.items():
+                # Keep the 1st old rule: it's the one loaded in the routing map
+                pending.setdefault(key, old_rule)
 
     def reset_update_required(self, http_id):
-        self._http_ids_to_update.discard(http_id)
+        """Reset update flag for given ir.http instance.
+
+        :return: changes to apply as a dict `{key: old rule}`
+            where old rule is None for rules not loaded yet.
+        """
+        return self._http_ids_to_update.pop(http_id, {})
+
+    def _set_rule(self, rule, existing=None):
+        if existing:
+            self._unindex_rule(existing)
+        self._mapping[rule.key] = rule
+        self._index_rule(rule)
+
+    def _index_rule(self, rule):
+        key = rule.key
+        self._rules_by_route[rule.route] = key
+        rule.dispatched = self._trie.add(rule.route, key) and self._is_dispatchable(
+            rule
+        )
+        if rule.route_group:
+            self._rules_by_group.setdefault(rule.route_group, {})[key] = True
+        model = self.key_model(key)
+        if model:
+            self._rules_by_model.setdefault(model, {})[key] = True
+
+    def _unindex_rule(self, rule):
+        key = rule.key
+        if self._rules_by_route.get(rule.route) == key:
+            del self._rules_by_route[rule.route]
+        self._trie.remove(rule.route, key)
+        self._unindex_key(self._rules_by_group, rule.route_group, key)
+        self._unindex_key(self._rules_by_model, self.key_model(key), key)
+
+    @staticmethod
+    def _unindex_key(index, value, key):
+        keys = index.get(value)
+        if keys is None:
+            return
+        keys.pop(key, None)
+        if not keys:
+            del index[value]
+
+    def _is_dispatchable(self, rule):
+        if rule.routing.get("type") != "http":
+            return False
+        route = rule.route
+        return any(
+            route == prefix or route.startswith(prefix + "/")
+            for prefix in self.dispatch_prefixes
+        )
+
+    @staticmethod
+    def key_model(key):
+        """Return the model name prefix of given key, if any.
+
+        Keys are usually in the form `model:id`.
+        """
+        model, sep, __ = key.rpartition(":")
+        return model if sep else None
 
     @classmethod
     def registry_for(cls, dbname):
         if dbname not in _REGISTRY_BY_DB:
-            _REGISTRY_BY_DB[dbname] = cls()
+            _REGISTRY_BY_DB[dbname] = cls(
+                dispatch_prefixes=cls._get_config_dispatch_prefixes()
+            )
         return _REGISTRY_BY_DB[dbname]
 
+    @staticmethod
+    def _get_config_dispatch_prefixes():
+        """Read prefixes from `endpoint_route_dispatch_prefixes` server option.
+
+        The option is a comma separated list of paths (eg: `/api,/my/endpoints`).
+        """
+        prefixes = config.get("endpoint_route_dispatch_prefixes") or ""
+        return tuple(
+            "/" + x.strip().strip("/") for x in prefixes.split(",") if x.strip("/ ")
+        )
+
     @classmethod
     def wipe_registry_for(cls, dbname):
         if dbname in _REGISTRY_BY_DB:
@@ -93,11 +288,125 @@ class EndpointRegistry:
     def make_rule(*a, **kw):
         return EndpointRule(*a, **kw)
 
+    # Cross-worker synchronization
+    #
+    # Each worker holds its own registry in memory.
+    # Every time a rule changes, its key is flagged in `endpoint_route_sync`
+    # w/ a new version taken from the counter in `endpoint_route_sync_version`.
+    # Workers compare their last known version w/ the counter
+    # and reload only the rules that changed meanwhile.
+    #
+    # The counter is a row, not a sequence: `nextval` is not transactional
+    # hence a worker could see a version before the rows flagged w/ it
+    # are committed and skip them forever. Updating the row locks it
+    # until the end of the transaction: versions are committed in order
+    # and a snapshot seeing a version sees all the rows flagged w/ it.
+
+    @staticmethod
+    def _setup_db(cr):
+        """Create the tables used to track changes."""
+        cr.execute(
+            """
+            CREATE TABLE IF NOT EXISTS endpoint_route_sync (
+                key VARCHAR PRIMARY KEY,
+                version BIGINT NOT NULL
+            )
+            """
+        )
+        cr.execute(
+            """
+            CREATE INDEX IF NOT EXISTS endpoint_route_sync_version_index
+            ON endpoint_route_sync (version)
+            """
+        )
+        cr.execute(
+            """
+            CREATE TABLE IF NOT EXISTS endpoint_route_sync_version (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                version BIGINT NOT NULL
+            )
+            """
+        )
+        cr.execute(
+            """
+            INSERT INTO endpoint_route_sync_version (id, version)
+            SELECT 1, COALESCE(MAX(version), 0) FROM endpoint_route_sync
+            ON CONFLICT (id) DO NOTHING
+            """
+        )
+        # Replaced by `endpoint_route_sync_version`
+        cr.execute("DROP SEQUENCE IF EXISTS endpoint_route_version")
+
+    def db_version(self, cr):
+        """Return the current version of the rules in the DB."""
+        cr.execute("SELECT version FROM endpoint_route_sync_version WHERE id = 1")
+        row = cr.fetchone()
+        return row[0] if row else 0
+
+    def init_version(self, cr):
+        """Set the known version if not done yet.
+
+        Must be called before loading rules from the DB
+        so that changes happening meanwhile are pulled later.
+        """
+        if self._version is None:
+            self._version = self.db_version(cr)
+
+    def notify_changes(self, cr, keys):
+        """Flag given rule keys as changed for other workers."""
+        keys = list(keys)
+        if not keys:
+            return
+        cr.execute(
+            """
+            UPDATE endpoint_route_sync_version SET version = version + 1
+            WHERE id = 1
+            RETURNING version
+            """
+        )
+        version = cr.fetchone()[0]
+        cr.execute(
+            """
+            INSERT INTO endpoint_route_sync (key, version)
+            SELECT key, %s FROM unnest(%s) AS key
+            ON CONFLICT (key) DO UPDATE SET version = EXCLUDED.version
+            """,
+            (version, keys),
+        )
+
+    def pull_changes(self, cr):
+        """Return the keys of the rules changed since the last pull.
+
+        When nothing changed, this costs only one query on the counter.
+        """
+        version = self.db_version(cr)
+        if self._version is None:
+            self._version = version
+            return []
+        if version <= self._version:
+            return []
+        cr.execute(
+            "SELECT key, version FROM endpoint_route_sync WHERE version > %s",
+            (self._version,),
+        )
+        rows = cr.fetchall()
+        # Advance only up to the rows actually read
+        self._version = max([self._version] + [x[1] for x in rows])
+        return [x[0] for x in rows]
+
 
 class EndpointRule:
     """Hold information for a custom endpoint rule."""
 
-    __slots__ = ("key", "route", "endpoint", "routing", "endpoint_hash", "route_group")
+    __slots__ = (
+        "key",
+        "route",
+        "endpoint",
+        "routing",
+        "endpoint_hash",
+        "route_group",
+        "dispatched",
+    )
 
     def __init__(self, key, route, endpoint, routing, endpoint_hash, route_group=None):
         self.key = key
@@ -106,8 +415,221 @@ class EndpointRule:
         self.routing = routing
         self.endpoint_hash = endpoint_hash
         self.route_group = route_group
+        # Set by the registry when the rule is dispatched w/o the routing map
+        self.dispatched = False
 
     def __repr__(self):
         return f"{self.key}: {self.route}" + (
             f"[{self.route_group}]" if self.route_group else ""
         )
+
+
+# Used only to instantiate converters
+_CONVERTERS_MAP = Map()
+
+
+class RouteTrie:
+    """Match paths against routes by path segment.
+
+    Routes can contain werkzeug default converters (eg: `/order/<int:id>`).
+    Path converters are supported only in the last segment.
+    Static segments take precedence over converters.
+    """
+
+    __slots__ = ("_root",)
+
+    def __init__(self):
+        self._root = _TrieNode()
+
+    @staticmethod
+    def _split(path):
+        return path[1:].split("/") if path.startswith("/") else path.split("/")
+
+    def add(self, route, key):
+        """Add given route.
+
+        :return: False if the route is not supported
+        """
+        segments = self._split(route)
+        try:
+            matchers = [_SegmentMatcher.from_segment(x) for x in segments]
+        except ValueError:
+            return False
+        if any(x is not None and x.is_path for x in matchers[:-1]):
+            return False
+        node = self._root
+        for segment, matcher in zip(segments, matchers):
+            if matcher is None:
+                node = node.static.setdefault(segment, _TrieNode())
+            elif matcher.is_path:
+                node.add_tail(matcher, key)
+                return True
+            else:
+                node = node.add_dynamic(matcher)
+        node.keys[key] = True
+        return True
+
+    def remove(self, route, key):
+        segments = self._split(route)
+        self._remove(self._root, segments, 0, key)
+
+    def _remove(self, node, segments, i, key):
+        """Remove key from the trie and prune empty nodes.
+
+        :return: True if the node is empty
+        """
+        if i == len(segments):
+            node.keys.pop(key, None)
+            return node.is_empty()
+        segment = segments[i]
+        if segment in node.static:
+            if self._remove(node.static[segment], segments, i + 1, key):
+                del node.static[segment]
+            return node.is_empty()
+        try:
+            matcher = _SegmentMatcher.from_segment(segment)
+        except ValueError:
+            return node.is_empty()
+        if matcher is None:
+            return node.is_empty()
+        if matcher.is_path:
+            node.remove_tail(matcher.pattern, key)
+            return node.is_empty()
+        child = node.dynamic.get(matcher.pattern)
+        if child is not None and self._remove(child[1], segments, i + 1, key):
+            node.remove_dynamic(matcher.pattern)
+        return node.is_empty()
+
+    def match(self, path):
+        """Yield `(key, params)` for all the routes matching given path."""
+        return self._match(self._root, self._split(path), 0, {})
+
+    def _match(self, node, segments, i, params):
+        if i == len(segments):
+            for key in node.keys:
+                yield key, params
+        else:
+            segment = segments[i]
+            child = node.static.get(segment)
+            if child is not None:
+                yield from self._match(child, segments, i + 1, params)
+            for matcher, child in node.dynamic_sorted:
+                values = matcher.match(segment)
+                if values is not None:
+                    yield from self._match(
+                        child, segments, i + 1, dict(params, **values)
+                    )
+        if node.tails and i < len(segments):
+            rest = "/".join(segments[i:])
+            for matcher, keys in node.tails.values():
+                values = matcher.match(rest)
+                if values is not None:
+                    for key in keys:
+                        yield key, dict(params, **values)
+
+
+class _TrieNode:
+
+    __slots__ = ("static", "dynamic", "dynamic_sorted", "tails", "keys")
+
+    def __init__(self):
+        # {segment: node}
+        self.static = {}
+        # {pattern: (matcher, node)}
+        self.dynamic = {}
+        # Dynamic children sorted by precedence
+        self.dynamic_sorted = ()
+        # Matchers of path converters: {pattern: (matcher, {key: True})}
+        self.tails = {}
+        # Keys of the routes ending here
+        self.keys = {}
+
+    def is_empty(self):
+        return not (self.static or self.dynamic or self.tails or self.keys)
+
+    def add_dynamic(self, matcher):
+        if matcher.pattern not in self.dynamic:
+            self.dynamic[matcher.pattern] = (matcher, _TrieNode())
+            self._sort_dynamic()
+        return self.dynamic[matcher.pattern][1]
+
+    def remove_dynamic(self, pattern):
+        del self.dynamic[pattern]
+        self._sort_dynamic()
+
+    def _sort_dynamic(self):
+        self.dynamic_sorted = tuple(
+            sorted(self.dynamic.values(), key=lambda x: x[0].weight)
+        )
+
+    def add_tail(self, matcher, key):
+        self.tails.setdefault(matcher.pattern, (matcher, {}))[1][key] = True
+
+    def remove_tail(self, pattern, key):
+        tail = self.tails.get(pattern)
+        if tail is None:
+            return
+        tail[1].pop(key, None)
+        if not tail[1]:
+            del self.tails[pattern]
+
+
+class _SegmentMatcher:
+    """Match a path segment containing converters."""
+
+    __slots__ = ("pattern", "regex", "converters", "is_path", "weight")
+
+    def __init__(self, pattern, regex, converters, is_path, weight):
+        self.pattern = pattern
+        self.regex = regex
+        self.converters = converters
+        self.is_path = is_path
+        self.weight = weight
+
+    @classmethod
+    def from_segment(cls, segment):
+        """Build a matcher for given segment.
+
+        :return: None for static segments
+        :raise: ValueError if the segment is not supported
+        """
+        if "<" not in segment:
+            return None
+        regex_parts = []
+        converters = []
+        is_path = False
+        static_len = 0
+        for converter, arguments, variable in parse_rule(segment):
+            if converter is None:
+                regex_parts.append(re.escape(variable))
+                static_len += len(variable)
+                continue
+            if converter not in Map.default_converters:
+                raise ValueError("Unsupported converter `%s`" % converter)
+            c_args, c_kwargs = (), {}
+            if arguments:
+                c_args, c_kwargs = parse_converter_args(arguments)
+            convobj = Map.default_converters[converter](
+                _CONVERTERS_MAP, *c_args, **c_kwargs
+            )
+            is_path = is_path or isinstance(convobj, PathConverter)
+            regex_parts.append("(?P<%s>%s)" % (variable, convobj.regex))
+            converters.append((variable, convobj))
+        regex = re.compile("^%s$" % "".join(regex_parts), re.UNICODE)
+        # Most static first, then converters w/ highest precedence first
+        weight = (-static_len, [x[1].weight for x in converters])
+        return cls(segment, regex, converters, is_path, weight)
+
+    def match(self, value):
+        """Return converted values or None if given value does not match."""
+        match = self.regex.match(value)
+        if match is None:
+            return None
+        values = {}
+        groups = match.groupdict()
+        try:
+            for variable, convobj in self.converters:
+                values[variable] = convobj.to_python(groups[variable])
+        except ValidationError:
+            return None
+        return values
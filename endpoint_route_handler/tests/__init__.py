@@ -1,2 +1,5 @@
 from . import test_endpoint
 from . import test_endpoint_controller
+from . import test_registry
+from . import test_apikeys
+from . import test_benchmark
@@ -0,0 +1,116 @@
+# Copyright 2021 Camptocamp SA
+# @author: Simone Orsi <simone.orsi@camptocamp.com>
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
+
+"""Tools to benchmark endpoint machinery at scale.
+
+Benchmarks are regular test cases tagged w/ `endpoint_benchmark`
+and excluded from standard test runs. Run them w/::
+
+    odoo -d $DB -i $MODULE --test-tags endpoint_benchmark --stop-after-init
+
+Environment variables:
+
+* ENDPOINT_BENCHMARK_SIZES: comma separated number of rules (default: 1000,10000,50000)
+* ENDPOINT_BENCHMARK_OUTPUT: directory where JSON results are stored
+  (default: system temp dir)
+"""
+
+import json
+import logging
+import os
+import platform
+import statistics
+import tempfile
+import time
+
+from odoo import release
+from odoo.modules.module import load_information_from_description_file
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_SIZES = "1000,10000,50000"
+
+
+class BenchmarkMixin:
+    """Mixin for test cases collecting timings and dumping them to JSON."""
+
+    # Name of the JSON file
+    _benchmark_name = "endpoint_benchmark"
+    # Module whose version is reported
+    _benchmark_module = "endpoint_route_handler"
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls._benchmark_results = []
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._benchmark_dump()
+        super().tearDownClass()
+
+    @classmethod
+    def _benchmark_sizes(cls):
+        sizes = os.getenv("ENDPOINT_BENCHMARK_SIZES") or DEFAULT_SIZES
+        return [int(x) for x in sizes.split(",") if x.strip()]
+
+    def _bench(self, name, size, func, repeat=5, per_call=1):
+        """Time `func` and store results.
+
+        :param name: benchmark name
+        :param size: number of rules in use
+        :param func: callable to time
+        :param repeat: number of runs
+        :param per_call: number of operations done by each call of `func`
+        :return: result of the last call
+        """
+        timings = []
+        res = None
+        for __ in range(repeat):
+            start = time.perf_counter()
+            res = func()
+            timings.append((time.perf_counter() - start) / per_call)
+        result = {
+            "name": name,
+            "size": size,
+            "runs": repeat,
+            "ops_per_run": per_call,
+            "min": min(timings),
+            "max": max(timings),
+            "mean": statistics.mean(timings),
+            "median": statistics.median(timings),
+        }
+        self._benchmark_results.append(result)
+        _logger.info(
+            "BENCHMARK %s [%s]: median %.6fs (min %.6fs, max %.6fs)",
+            name,
+            size,
+            result["median"],
+            result["min"],
+            result["max"],
+        )
+        return res
+
+    @classmethod
+    def _benchmark_dump(cls):
+        if not cls._benchmark_results:
+            return
+        path = os.getenv("ENDPOINT_BENCHMARK_OUTPUT") or tempfile.gettempdir()
+        os.makedirs(path, exist_ok=True)
+        filepath = os.path.join(
+            path, "{}-{}.json".format(cls._benchmark_name, int(time.time()))
+        )
+        data = {
+            "benchmark": cls._benchmark_name,
+            "module_version": load_information_from_description_file(
+                cls._benchmark_module
+            ).get("version"),
+            "odoo_version": release.version,
+            "python_version": platform.python_version(),
+            "timestamp": time.time(),
+            "results": cls._benchmark_results,
+        }
+        with open(filepath, "w") as fd:
+            json.dump(data, fd, indent=2)
+        _logger.info("BENCHMARK results stored in %s", filepath)
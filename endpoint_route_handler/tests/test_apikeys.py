@@ -0,0 +1,77 @@
+# Copyright 2021 Camptocamp SA
+# @author: Simone Orsi <simone.orsi@camptocamp.com>
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
+
+from unittest import mock
+
+from werkzeug.exceptions import Unauthorized
+
+from odoo.tools import DotDict
+
+from ..models import res_users_apikeys
+from .common import CommonEndpoint
+
+
+class TestApiKeys(CommonEndpoint):
+    @classmethod
+    def _setup_records(cls):
+        super()._setup_records()
+        cls.user = cls.env.ref("base.user_demo")
+        cls.apikeys = cls.env["res.users.apikeys"]
+        cls.key = cls.apikeys.with_user(cls.user)._generate("endpoint", "Test")
+
+    def setUp(self):
+        super().setUp()
+        res_users_apikeys._API_KEY_CACHE.clear()
+
+    def _check_credentials(self, key):
+        crypt_context = res_users_apikeys.KEY_CRYPT_CONTEXT
+        with mock.patch.object(
+            crypt_context, "verify", wraps=crypt_context.verify
+        ) as verify:
+            uid = self.apikeys._endpoint_check_credentials(key)
+        return uid, verify.call_count
+
+    def test_check_credentials(self):
+        self.assertEqual(self._check_credentials(self.key), (self.user.id, 1))
+        # Verified once
+        self.assertEqual(self._check_credentials(self.key), (self.user.id, 0))
+        self.assertEqual(self._check_credentials("wrong" + self.key)[0], None)
+
+    def test_check_credentials_scope(self):
+        key = self.apikeys.with_user(self.user)._generate("rpc", "Test RPC")
+        self.assertIsNone(self._check_credentials(key)[0])
+        key = self.apikeys.with_user(self.user)._generate(None, "Test all")
+        self.assertEqual(self._check_credentials(key)[0], self.user.id)
+
+    def test_check_credentials_revoked(self):
+        self.assertEqual(self._check_credentials(self.key)[0], self.user.id)
+        self.apikeys.search([("user_id", "=", self.user.id)]).unlink()
+        self.assertIsNone(self._check_credentials(self.key)[0])
+
+    def test_check_credentials_revoked_elsewhere(self):
+        self.assertEqual(self._check_credentials(self.key)[0], self.user.id)
+        # Removed w/o the ORM, eg: by another worker
+        self.env.cr.execute(
+            "DELETE FROM res_users_apikeys WHERE user_id = %s", (self.user.id,)
+        )
+        self.assertEqual(self._check_credentials(self.key), (None, 0))
+
+    def test_get_api_key(self):
+        ir_http = self.env["ir.http"]
+        for headers, expected in (
+            ({}, None),
+            ({"API-KEY": "abc"}, "abc"),
+            ({"Authorization": "Bearer abc"}, "abc"),
+            ({"Authorization": "Basic abc"}, None),
+        ):
+            httprequest = DotDict({"headers": headers})
+            self.assertEqual(ir_http._endpoint_get_api_key(httprequest), expected)
+
+    def test_auth_method_api_key(self):
+        with self._get_mocked_request(extra_headers={"API-KEY": self.key}) as req:
+            self.env["ir.http"]._auth_method_api_key()
+            self.assertEqual(req.uid, self.user.id)
+        with self._get_mocked_request(extra_headers={"API-KEY": "wrong"}):
+            with self.assertRaises(Unauthorized):
+                self.env["ir.http"]._auth_method_api_key()
@@ -0,0 +1,108 @@
+# Copyright 2021 Camptocamp SA
+# @author: Simone Orsi <simone.orsi@camptocamp.com>
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
+
+import random
+from unittest import mock
+
+from odoo.http import Controller, EndPoint
+from odoo.tests.common import tagged
+
+from .. import registry as registry_module
+from ..registry import EndpointRegistry
+from .benchmark import BenchmarkMixin
+from .common import CommonEndpoint
+
+
+class BenchController(Controller):
+    def _handle(self, **kw):
+        return "ok"
+
+
+@tagged("-standard", "-at_install", "post_install", "endpoint_benchmark")
+class TestBenchmarkRegistry(BenchmarkMixin, CommonEndpoint):
+
+    _benchmark_name = "endpoint_route_handler_registry"
+
+    def tearDown(self):
+        self.env["ir.http"]._clear_routing_map()
+        super().tearDown()
+
+    def _make_rules(self, registry, size):
+        handler = BenchController()._handle
+        rules = []
+        for i in range(size):
+            # Mix static and dynamic routes
+            if i % 2:
+                route = "/bench/{}/<int:res_id>".format(i)
+            else:
+                route = "/bench/{}".format(i)
+            routing = dict(
+                type="http",
+                auth="public",
+                methods=["GET"],
+                routes=[route],
+                csrf=False,
+            )
+            rules.append(
+                registry.make_rule(
+                    "bench:{}".format(i),
+                    route,
+                    EndPoint(handler, routing),
+                    routing,
+                    hash(route),
+                    route_group="group_{}".format(i % 10),
+                )
+            )
+        return rules
+
+    def _sample_paths(self, size, count=100):
+        paths = []
+        for i in random.sample(range(size), min(count, size)):
+            paths.append("/bench/{}/42".format(i) if i % 2 else "/bench/{}".format(i))
+        return paths
+
+    def test_benchmark(self):
+        dbname = self.env.cr.dbname
+        for size in self._benchmark_sizes():
+            registry = EndpointRegistry()
+            with mock.patch.dict(registry_module._REGISTRY_BY_DB, {dbname: registry}):
+                self._benchmark_size(registry, size)
+
+    def _benchmark_size(self, registry, size):
+        rules = self._make_rules(registry, size)
+
+        def add_rules():
+            for rule in rules:
+                registry.add_or_update_rule(rule, force=True)
+
+        self._bench("registry_add_or_update_rule", size, add_rules, per_call=size)
+        self._bench(
+            "registry_get_rules_by_group",
+            size,
+            lambda: list(registry.get_rules_by_group("group_1")),
+        )
+        ir_http = self.env["ir.http"]
+        with self._get_mocked_request():
+
+            def rebuild():
+                ir_http._clear_routing_map()
+                return ir_http.routing_map()
+
+            rmap = self._bench("routing_map_rebuild", size, rebuild, repeat=3)
+            self.assertGreaterEqual(len(rmap._rules), size)
+            adapter = rmap.bind("localhost")
+            paths = self._sample_paths(size)
+            self._bench(
+                "routing_map_match",
+                size,
+                lambda: [adapter.match(path, method="GET") for path in paths],
+                per_call=len(paths),
+            )
+            rule = rules[0]
+
+            def patch():
+                registry.add_or_update_rule(rule, force=True)
+                return ir_http.routing_map()
+
+            self._bench("routing_map_patch_one_rule", size, patch)
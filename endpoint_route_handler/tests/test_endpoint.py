@@ -2,10 +2,18 @@
 # @author: Simone Orsi <simone.orsi@camptocamp.com>
 # License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
 
-
 from functools import partial
+from unittest import mock
+
+import psycopg2
+from psycopg2 import errorcodes
+from werkzeug.exceptions import MethodNotAllowed, NotFound
 
+from odoo import sql_db
+from odoo.exceptions import UserError
 from odoo.http import Controller
+from odoo.tools import config
+from odoo.tools.misc import mute_logger
 
 from ..registry import EndpointRegistry
 from .common import CommonEndpoint
@@ -28,6 +36,41 @@ class TestEndpoint(CommonEndpoint):
         new_route._refresh_endpoint_data()
         return new_route
 
+    @mute_logger("odoo.sql_db")
+    def test_read_only_env(self):
+        with self.route_handler._endpoint_read_only_env() as env:
+            self.assertIsNot(env.cr, self.env.cr)
+            self.assertEqual(env.cr.dbname, self.env.cr.dbname)
+            with self.assertRaises(psycopg2.InternalError) as cm:
+                env.cr.execute("UPDATE res_users SET write_date = now()")
+            self.assertEqual(cm.exception.pgcode, errorcodes.READ_ONLY_SQL_TRANSACTION)
+        with self.assertRaises(psycopg2.InternalError) as cm:
+            with self.route_handler._endpoint_read_only_env() as env:
+                env.user.name = "Changed"
+        self.assertEqual(cm.exception.pgcode, errorcodes.READ_ONLY_SQL_TRANSACTION)
+
+    def test_read_only_env_isolated(self):
+        partner = self.env.user.partner_id
+        partner.ref = "Not committed"
+        field = partner._fields["ref"]
+        with self.route_handler._endpoint_read_only_env() as env:
+            self.assertIsNot(env.cache, self.env.cache)
+            # Flushed but not committed: not visible from the read-only cursor
+            self.assertNotEqual(env.user.partner_id.ref, "Not committed")
+            self.assertIsNot(env.user.with_context(foo=1).env.cache, self.env.cache)
+        # The caller's cache is left untouched
+        self.assertTrue(self.env.cache.contains(partner, field))
+        self.assertEqual(self.env.cache.get(partner, field), "Not committed")
+
+    def test_read_only_env_uri(self):
+        uri = "postgresql://replica/" + self.env.cr.dbname
+        with mock.patch.dict(config.options, {"endpoint_read_only_db_uri": uri}):
+            with mock.patch.object(sql_db, "db_connect") as db_connect:
+                with self.route_handler._endpoint_read_only_env():
+                    pass
+        db_connect.assert_called_once_with(uri, allow_uri=True)
+        db_connect.return_value.cursor.return_value.close.assert_called_once()
+
     def test_as_tool_base_data(self):
         new_route = self._make_new_route()
         self.assertEqual(new_route.route, "/my/test/route")
@@ -63,9 +106,40 @@ class TestEndpoint(CommonEndpoint):
         new_route._refresh_endpoint_data()
         with self._get_mocked_request():
             new_route._register_controller(endpoint_handler=endpoint_handler)
-            rmap = self.env["ir.http"].routing_map()
+            new_rmap = self.env["ir.http"].routing_map()
+            # The routing map is patched, not rebuilt
+            self.assertIs(new_rmap, rmap)
             self.assertNotIn("/my/test/route", [x.rule for x in rmap._rules])
             self.assertIn("/my/test/route/new", [x.rule for x in rmap._rules])
+        # Ensure is dropped when needed
+        with self._get_mocked_request():
+            new_route._unregister_controller()
+            rmap = self.env["ir.http"].routing_map()
+            self.assertIs(new_rmap, rmap)
+            self.assertNotIn("/my/test/route/new", [x.rule for x in rmap._rules])
+
+    def test_routing_map_sync_once(self):
+        handler_cls = type(self.env["endpoint.route.handler"])
+        with mock.patch.object(handler_cls, "_endpoint_registry_sync") as mocked:
+            with self._get_mocked_request():
+                self.env["ir.http"].routing_map()
+                self.env["ir.http"].routing_map()
+            # Changes of other workers are pulled once per request
+            self.assertEqual(mocked.call_count, 1)
+
+    def test_stateless(self):
+        new_route = self._make_new_route(auth_type="public")
+        __, routing, first_hash = new_route._get_routing_info()
+        self.assertNotIn("save_session", routing)
+        new_route.stateless = True
+        new_route._refresh_endpoint_data()
+        __, routing, endpoint_hash = new_route._get_routing_info()
+        self.assertFalse(routing["save_session"])
+        self.assertNotEqual(endpoint_hash, first_hash)
+        new_route._check_stateless()
+        new_route.auth_type = "user_endpoint"
+        with self.assertRaisesRegex(UserError, "stateless mode is not allowed"):
+            new_route._check_stateless()
 
     def test_as_tool_register_controller_dynamic_route(self):
         route = "/my/app/<model(app.model):foo>"
@@ -82,4 +156,57 @@ class TestEndpoint(CommonEndpoint):
             rmap = self.env["ir.http"].routing_map()
             self.assertIn(route, [x.rule for x in rmap._rules])
 
+    def test_as_tool_register_controller_dispatched(self):
+        route = "/my/test/<int:res_id>"
+        new_route = self._make_new_route(route=route)
+
+        class TestController(Controller):
+            def _do_something(self, res_id=None, **params):
+                return "ok {}".format(res_id)
+
+        endpoint_handler = TestController()._do_something
+        ir_http = self.env["ir.http"]
+        # Start from scratch to get a registry w/ dispatch prefixes
+        ir_http._clear_routing_map()
+        EndpointRegistry.wipe_registry_for(self.env.cr.dbname)
+        with mock.patch.object(
+            EndpointRegistry, "_get_config_dispatch_prefixes", return_value=("/my",)
+        ):
+            registry = new_route._endpoint_registry
+        self.assertEqual(registry.dispatch_prefixes, ("/my",))
+        with self._get_mocked_request():
+            rmap = ir_http.routing_map()
+            new_route._register_controller(endpoint_handler=endpoint_handler)
+            # Only the catch-all rule is in the routing map
+            routes = [x.rule for x in rmap._rules]
+            self.assertIn("/my/<path:_ignored_endpoint_path>", routes)
+            self.assertNotIn(route, routes)
+            # The routing map does not need any update
+            http_id = ir_http._endpoint_make_http_id()
+            self.assertFalse(registry.routing_update_required(http_id))
+        endpoint_rule = registry.get_rule(new_route._endpoint_registry_unique_key())
+        self.assertTrue(endpoint_rule.dispatched)
+        with self._get_mocked_request(
+            httprequest={"path": "/my/test/10", "method": "GET"}
+        ) as req, mock.patch.object(
+            type(ir_http), "_authenticate", return_value="user_endpoint"
+        ) as mocked_auth:
+            ir_http._endpoint_dispatch()
+            mocked_auth.assert_called_once_with(endpoint_rule.endpoint)
+            endpoint, arguments, auth_method = req.set_handler.call_args[0]
+            self.assertEqual(arguments, {"res_id": 10})
+            self.assertEqual(auth_method, "user_endpoint")
+            self.assertEqual(endpoint.routing, endpoint_rule.routing)
+            self.assertEqual(endpoint(), "ok 10")
+        with self._get_mocked_request(
+            httprequest={"path": "/my/test/foo", "method": "GET"}
+        ):
+            with self.assertRaises(NotFound):
+                ir_http._endpoint_dispatch()
+        with self._get_mocked_request(
+            httprequest={"path": "/my/test/10", "method": "POST"}
+        ):
+            with self.assertRaises(MethodNotAllowed):
+                ir_http._endpoint_dispatch()
+
     # TODO: test unregister
@@ -0,0 +1,234 @@
+# Copyright 2021 Camptocamp SA
+# @author: Simone Orsi <simone.orsi@camptocamp.com>
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
+
+from werkzeug.exceptions import MethodNotAllowed
+
+from odoo.tests.common import TransactionCase
+
+from ..registry import EndpointRegistry
+
+
+class TestRegistry(TransactionCase):
+    def setUp(self):
+        super().setUp()
+        self.registry = EndpointRegistry()
+        self.http_id = 1
+        self.registry.ir_http_track(self.http_id)
+
+    def _make_rule(self, key, route, route_group=None):
+        routing = dict(
+            type="http", auth="public", methods=["GET"], routes=[route], csrf=False
+        )
+        return self.registry.make_rule(
+            key, route, object(), routing, hash(route), route_group=route_group
+        )
+
+    def test_add_or_update_rules(self):
+        rules = [
+            self._make_rule("test:{}".format(i), "/test/{}".format(i)) for i in range(3)
+        ]
+        keys = self.registry.add_or_update_rules(rules)
+        self.assertEqual(keys, ["test:0", "test:1", "test:2"])
+        self.assertTrue(self.registry.routing_update_required(self.http_id))
+        changes = self.registry.reset_update_required(self.http_id)
+        self.assertEqual(changes, {"test:0": None, "test:1": None, "test:2": None})
+        self.assertFalse(self.registry.routing_update_required(self.http_id))
+        # Same rules: nothing changes
+        self.assertEqual(self.registry.add_or_update_rules(rules), [])
+        self.assertFalse(self.registry.routing_update_required(self.http_id))
+        # Update one rule
+        new_rule = self._make_rule("test:1", "/test/1/new")
+        self.assertEqual(self.registry.add_or_update_rules([new_rule]), ["test:1"])
+        changes = self.registry.reset_update_required(self.http_id)
+        self.assertEqual(changes, {"test:1": rules[1]})
+        self.assertIsNone(self.registry.get_rule_by_route("/test/1"))
+        self.assertEqual(self.registry.get_rule_by_route("/test/1/new"), new_rule)
+
+    def test_add_or_update_rules_init(self):
+        rules = [
+            self._make_rule("test:{}".format(i), "/test/{}".format(i)) for i in range(3)
+        ]
+        keys = self.registry.add_or_update_rules(rules, init=True)
+        self.assertEqual(len(keys), 3)
+        self.assertFalse(self.registry.routing_update_required(self.http_id))
+
+    def test_drop_rules(self):
+        rules = [
+            self._make_rule("test:{}".format(i), "/test/{}".format(i)) for i in range(3)
+        ]
+        self.registry.add_or_update_rules(rules)
+        self.registry.reset_update_required(self.http_id)
+        keys = self.registry.drop_rules(["test:0", "test:2", "test:unknown"])
+        self.assertEqual(keys, ["test:0", "test:2"])
+        changes = self.registry.reset_update_required(self.http_id)
+        self.assertEqual(changes, {"test:0": rules[0], "test:2": rules[2]})
+        self.assertEqual(list(self.registry.get_rules()), [rules[1]])
+        self.assertIsNone(self.registry.get_rule_by_route("/test/0"))
+
+    def _make_group_rules(self):
+        rules = [
+            self._make_rule(
+                "model.a:{}".format(i), "/a/{}".format(i), route_group="group_a"
+            )
+            for i in range(3)
+        ]
+        rules += [
+            self._make_rule(
+                "model.b:{}".format(i), "/b/{}".format(i), route_group="group_b"
+            )
+            for i in range(2)
+        ]
+        rules.append(self._make_rule("custom_key", "/custom"))
+        self.registry.add_or_update_rules(rules)
+        return rules
+
+    def test_get_rules_by_group(self):
+        rules = self._make_group_rules()
+        self.assertEqual(
+            dict(self.registry.get_rules_by_group("group_a")),
+            {x.key: x for x in rules[:3]},
+        )
+        self.assertEqual(
+            dict(self.registry.get_rules_by_group("group_b")),
+            {x.key: x for x in rules[3:5]},
+        )
+        self.assertEqual(list(self.registry.get_rules_by_group("nope")), [])
+        # Moving a rule to another group updates the index
+        moved = self._make_rule("model.a:0", "/a/0", route_group="group_b")
+        self.registry.add_or_update_rules([moved], force=True)
+        self.assertNotIn("model.a:0", dict(self.registry.get_rules_by_group("group_a")))
+        self.assertEqual(
+            dict(self.registry.get_rules_by_group("group_b"))["model.a:0"], moved
+        )
+
+    def test_get_rules_by_model(self):
+        rules = self._make_group_rules()
+        self.assertEqual(
+            dict(self.registry.get_rules_by_model("model.a")),
+            {x.key: x for x in rules[:3]},
+        )
+        self.assertEqual(list(self.registry.get_rules_by_model("custom_key")), [])
+        self.assertEqual(EndpointRegistry.key_model("model.a:1"), "model.a")
+        self.assertIsNone(EndpointRegistry.key_model("custom_key"))
+
+    def test_drop_rules_by_group(self):
+        rules = self._make_group_rules()
+        self.registry.reset_update_required(self.http_id)
+        keys = self.registry.drop_rules_by_group("group_a")
+        self.assertEqual(sorted(keys), sorted(x.key for x in rules[:3]))
+        self.assertEqual(
+            sorted(self.registry.reset_update_required(self.http_id)), sorted(keys)
+        )
+        self.assertEqual(list(self.registry.get_rules_by_group("group_a")), [])
+        self.assertEqual(list(self.registry.get_rules_by_model("model.a")), [])
+        self.assertIsNone(self.registry.get_rule_by_route("/a/1"))
+        self.assertNotIn("group_a", self.registry._rules_by_group)
+        self.assertEqual(len(self.registry.get_rules()), 3)
+        self.assertEqual(self.registry.drop_rules_by_group("group_a"), [])
+
+    def test_drop_rules_by_model(self):
+        rules = self._make_group_rules()
+        keys = self.registry.drop_rules_by_model("model.b")
+        self.assertEqual(sorted(keys), sorted(x.key for x in rules[3:5]))
+        self.assertEqual(list(self.registry.get_rules_by_group("group_b")), [])
+        self.assertEqual(len(self.registry.get_rules()), 4)
+
+    def test_match(self):
+        rules = [
+            self._make_rule("test:1", "/test/order/<int:order_id>"),
+            self._make_rule("test:2", "/test/order/new"),
+            self._make_rule("test:3", "/test/files/<path:filepath>"),
+            self._make_rule("test:4", "/test/order/<name>/lines"),
+            self._make_rule("test:5", "/test/item-<int:a>-<string(length=2):b>"),
+        ]
+        self.registry.add_or_update_rules(rules)
+        self.assertEqual(
+            self.registry.match("/test/order/12", "GET"), (rules[0], {"order_id": 12})
+        )
+        self.assertEqual(self.registry.match("/test/order/new", "GET"), (rules[1], {}))
+        self.assertEqual(
+            self.registry.match("/test/files/a/b.txt", "GET"),
+            (rules[2], {"filepath": "a/b.txt"}),
+        )
+        self.assertEqual(
+            self.registry.match("/test/order/foo/lines", "GET"),
+            (rules[3], {"name": "foo"}),
+        )
+        self.assertEqual(
+            self.registry.match("/test/item-1-ab", "GET"),
+            (rules[4], {"a": 1, "b": "ab"}),
+        )
+        # HEAD is allowed when GET is
+        self.assertEqual(self.registry.match("/test/order/new", "HEAD")[0], rules[1])
+        self.assertEqual(self.registry.match("/test/order/foo", "GET"), (None, None))
+        self.assertEqual(self.registry.match("/test/item-1-abc", "GET"), (None, None))
+        with self.assertRaises(MethodNotAllowed):
+            self.registry.match("/test/order/12", "POST")
+        # Dropped rules are not matched anymore
+        self.registry.drop_rules(["test:1", "test:3"])
+        self.assertEqual(self.registry.match("/test/order/12", "GET"), (None, None))
+        self.assertEqual(self.registry.match("/test/files/a", "GET"), (None, None))
+        self.registry.drop_rules([x.key for x in rules])
+        self.assertTrue(self.registry._trie._root.is_empty())
+
+    def test_dispatched(self):
+        registry = EndpointRegistry(dispatch_prefixes=("/api",))
+        registry.ir_http_track(self.http_id)
+        rules = [
+            self._make_rule("test:1", "/api/order/<int:order_id>"),
+            self._make_rule("test:2", "/other/order/<int:order_id>"),
+            # Not supported by the dispatcher
+            self._make_rule("test:3", "/api/partner/<model('res.partner'):partner>"),
+        ]
+        json_rule = self._make_rule("test:4", "/api/json")
+        json_rule.routing["type"] = "json"
+        rules.append(json_rule)
+        registry.add_or_update_rules(rules)
+        self.assertEqual([x.dispatched for x in rules], [True, False, False, False])
+        # Only rules in the routing map require an update
+        self.assertEqual(
+            sorted(registry.reset_update_required(self.http_id)),
+            ["test:2", "test:3", "test:4"],
+        )
+        self.assertEqual(
+            registry.match("/api/order/1", "GET", dispatched_only=True),
+            (rules[0], {"order_id": 1}),
+        )
+        self.assertEqual(
+            registry.match("/other/order/1", "GET", dispatched_only=True),
+            (None, None),
+        )
+        registry.drop_rules(["test:1"])
+        self.assertFalse(registry.routing_update_required(self.http_id))
+        # Moving a rule out of the prefix adds it to the routing map
+        registry.add_or_update_rules([self._make_rule("test:1", "/api/order/new")])
+        registry.add_or_update_rules([self._make_rule("test:1", "/order/new")])
+        self.assertEqual(list(registry.reset_update_required(self.http_id)), ["test:1"])
+
+    def test_pull_changes_concurrent_transactions(self):
+        # Use real transactions: changes must be committed to be seen
+        writer_cr = self.env.registry.cursor()
+        reader_cr = self.env.registry.cursor()
+        writer_registry = EndpointRegistry()
+        reader_registry = EndpointRegistry()
+        key = "test.sync:concurrent"
+        try:
+            reader_registry.init_version(reader_cr)
+            reader_cr.rollback()
+            writer_registry.notify_changes(writer_cr, [key])
+            # Not committed yet: nothing to pull
+            self.assertEqual(reader_registry.pull_changes(reader_cr), [])
+            reader_cr.rollback()
+            writer_cr.commit()
+            # Once committed, the change is pulled
+            self.assertEqual(reader_registry.pull_changes(reader_cr), [key])
+            reader_cr.rollback()
+            self.assertEqual(reader_registry.pull_changes(reader_cr), [])
+        finally:
+            reader_cr.rollback()
+            writer_cr.rollback()
+            writer_cr.execute("DELETE FROM endpoint_route_sync WHERE key = %s", (key,))
+            writer_cr.commit()
+            reader_cr.close()
+            writer_cr.close()